@@ -0,0 +1,127 @@
+"""
+Compares the prompt formats of `fine_tune.prompt_template` on a sample of the
+instruction dataset: number of tokens per prompt and, optionally, the time of a
+training step (forward and backward pass) on batches of each format.
+"""
+
+import statistics
+import time
+
+import datasets
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from fine_tune.data import tokenize_conversations
+from fine_tune.prompt_template import PROMPT_FORMATS
+
+
+def get_token_stats(lengths: list[int]) -> dict[str, float]:
+    lengths = sorted(lengths)
+    return {
+        "mean": statistics.mean(lengths),
+        "p50": lengths[len(lengths) // 2],
+        "p95": lengths[min(int(0.95 * len(lengths)), len(lengths) - 1)],
+        "max": lengths[-1],
+    }
+
+
+def measure_step_time(
+    model,
+    tokenizer,
+    input_ids: list[list[int]],
+    batch_size: int,
+    n_steps: int,
+) -> float:
+    """
+    Returns the mean time in seconds of a forward and backward pass over padded
+    batches of `input_ids`, after a warmup step.
+    """
+    step_times = []
+    for step in range(n_steps + 1):
+        start = step * batch_size % len(input_ids)
+        batch = tokenizer.pad(
+            {"input_ids": input_ids[start : start + batch_size]},
+            return_tensors="pt",
+        ).to(model.device)
+        labels = batch["input_ids"].masked_fill(batch["attention_mask"] == 0, -100)
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        loss = model(**batch, labels=labels).loss
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        # The first step includes the warmup of the kernels
+        if step > 0:
+            step_times.append(time.perf_counter() - start_time)
+
+    return statistics.mean(step_times)
+
+
+def benchmark_prompt_formats(
+    model_name: str = "LiquidAI/LFM2-350M",
+    dataset_name: str = "Paulescu/MagnusInstruct",
+    n_samples: int = 1000,
+    max_seq_length: int = 2048,
+    step_time: bool = True,
+    batch_size: int = 16,
+    n_steps: int = 10,
+):
+    """
+    Prints, for each prompt format, the statistics of the number of tokens per
+    prompt (chat-templated, up to the start of the answer) and, if `step_time`, the
+    mean time of a training step with `batch_size` whole conversations.
+    """
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    examples = datasets.load_dataset(dataset_name, split="train")[:n_samples]
+
+    model = None
+    if step_time:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        print(f"Loading {model_name} on {device} to measure step times...")
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.bfloat16 if device == "cuda" else torch.float32,
+        ).to(device)
+        model.train()
+
+    results = {}
+    for prompt_format in PROMPT_FORMATS:
+        print(f"Benchmarking the {prompt_format} prompt format...")
+        columns = tokenize_conversations(
+            examples, tokenizer, max_seq_length, prompt_format
+        )
+        # Only the prompt differs between formats: leave out the answer tokens
+        results[prompt_format] = get_token_stats(
+            [
+                len(assistant_masks) - sum(assistant_masks)
+                for assistant_masks in columns["assistant_masks"]
+            ]
+        )
+        if model is not None:
+            results[prompt_format]["step_time_s"] = measure_step_time(
+                model, tokenizer, columns["input_ids"], batch_size, n_steps
+            )
+
+    print(
+        f"{'Prompt format':<24} {'Prompt tokens: mean':>20} {'P50':>6} {'P95':>6} "
+        f"{'Max':>6} {'Step time (s)':>14}"
+    )
+    for prompt_format, stats in results.items():
+        step_time_s = stats.get("step_time_s")
+        print(
+            f"{prompt_format:<24} {stats['mean']:>20.1f} {stats['p50']:>6} "
+            f"{stats['p95']:>6} {stats['max']:>6} "
+            f"{'-' if step_time_s is None else f'{step_time_s:.3f}':>14}"
+        )
+
+
+if __name__ == "__main__":
+    from fire import Fire
+
+    Fire(benchmark_prompt_formats)
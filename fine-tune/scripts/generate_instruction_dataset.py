@@ -1,126 +1,521 @@
 import glob
 import json
 import os
+import re
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 
 import chess
 import chess.pgn
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from datasets import Dataset
 from tqdm import tqdm
 
+from fine_tune.encoding import decode_positions, encode_move, encode_moves
+
+# Schemas of the processed Parquet files. Keeping them explicit means every shard
+# has the same column types, even the ones without data points.
+#
+# Moves are packed into 16-bit integers (see `fine_tune.encoding`). Positions only
+# store their `move_number` (ply index) into the game, and the moves played so far
+# live once per game in the games table, instead of once per position.
+POSITION_SCHEMA = pa.schema(
+    [
+        ("game_id", pa.int64()),
+        ("move_number", pa.uint16()),
+        ("game_state", pa.string()),
+        ("last_5_moves_packed", pa.list_(pa.uint16())),
+        ("valid_moves_packed", pa.list_(pa.uint16())),
+        ("next_move", pa.string()),
+        ("player_to_move", pa.string()),
+    ]
+)
+GAME_SCHEMA = pa.schema(
+    [
+        ("game_id", pa.int64()),
+        ("white_player", pa.string()),
+        ("black_player", pa.string()),
+        ("moves_packed", pa.list_(pa.uint16())),
+    ]
+)
 
-def count_games(pgn_file_path: str) -> int:
-    """Count total number of games in PGN file."""
-    game_count = 0
-    with open(pgn_file_path) as pgn_file:
-        while chess.pgn.read_game(pgn_file) is not None:
-            game_count += 1
-    return game_count
 
+@dataclass(frozen=True)
+class PlayerFilter:
+    """
+    Selects the positions to extract, based on the headers of each game.
 
-def extract_game_data(pgn_file_path: str) -> list[dict[str, Any]]:
+    A side of a game matches if its player name matches the `name` regex, its colour
+    is `color` ("white" or "black") and its Elo is between `min_elo` and `max_elo`.
+    Criteria set to None always match. Games where the Elo is required but missing
+    do not match.
     """
-    Parse PGN file and extract move sequences, game states, and valid moves for each
-    position.
 
-    Returns:
-        List of dictionaries containing:
-        - moves_uci: List of moves in UCI notation up to this position
-        - game_state: FEN string representing board state after moves
-        - valid_moves: List of valid next moves in UCI notation
+    name: str | None = None
+    color: str | None = None
+    min_elo: int | None = None
+    max_elo: int | None = None
+
+    def __post_init__(self):
+        if self.color not in (None, "white", "black"):
+            raise ValueError(f"Invalid color: {self.color}")
+
+    def get_sides(self, headers: chess.pgn.Headers) -> list[chess.Color]:
+        """
+        Returns the colours whose positions must be extracted from the game with
+        the given `headers`.
+        """
+        sides = []
+        for color, color_name in [(chess.WHITE, "White"), (chess.BLACK, "Black")]:
+            if self.color is not None and self.color != color_name.lower():
+                continue
+
+            if self.name is not None and not re.search(
+                self.name, headers.get(color_name, "Unknown")
+            ):
+                continue
+
+            if self.min_elo is not None or self.max_elo is not None:
+                try:
+                    elo = int(headers.get(f"{color_name}Elo", ""))
+                except ValueError:
+                    continue
+                if self.min_elo is not None and elo < self.min_elo:
+                    continue
+                if self.max_elo is not None and elo > self.max_elo:
+                    continue
+
+            sides.append(color)
+
+        return sides
+
+
+def extract_game_data(
+    pgn_file_path: str,
+    player_filter: PlayerFilter | None = None,
+    start_offset: int = 0,
+    end_offset: int | None = None,
+    first_game_id: int = 0,
+    show_progress: bool = True,
+) -> Iterator[dict[str, Any]]:
+    """
+    Parse PGN file and yield, for each game, its moves and the game states and valid
+    moves of each of its positions.
+
+    The file is read in a single pass. Progress is reported in bytes read, and when
+    `player_filter` is given, games where no side matches it are skipped after
+    reading their headers, without parsing their moves. In the other games, only
+    the positions of the matching sides are extracted.
+
+    `start_offset` and `end_offset` restrict the extraction to the games between
+    these two byte offsets, which must be game boundaries (see `split_pgn_file`).
+
+    Yields:
+        Dictionaries with the columns of `GAME_SCHEMA`, plus a `positions` list of
+        dictionaries with the columns of `POSITION_SCHEMA`:
+        - game_id: Unique identifier for the game, starting at `first_game_id`
         - move_number: Position in the game (0-indexed)
-        - game_id: Unique identifier for the game
+        - game_state: FEN string representing board state before the move
+        - last_5_moves_packed: Last 5 moves played before this position
+        - valid_moves_packed: Valid next moves
+        - next_move: The move actually played, in UCI notation
+        - player_to_move: Name of the player making the move
     """
-    extracted_data = []
-    game_id = 0
+    game_id = first_game_id
+    n_skipped_games = 0
 
-    total_games = count_games(pgn_file_path)
-    print(f"Total games in PGN: {total_games}")
+    if end_offset is None:
+        end_offset = os.path.getsize(pgn_file_path)
 
     with open(pgn_file_path) as pgn_file:
-        with tqdm(total=total_games, desc="Processing games") as pbar:
-            while True:
+        pgn_file.seek(start_offset)
+        with tqdm(
+            total=end_offset - start_offset,
+            unit="B",
+            unit_scale=True,
+            desc="Processing games",
+            disable=not show_progress,
+        ) as pbar:
+            while pgn_file.tell() < end_offset:
+                game_offset = pgn_file.tell()
+
+                sides = [chess.WHITE, chess.BLACK]
+
+                if player_filter is not None:
+                    # Cheap pass over the headers, without parsing the moves
+                    headers = chess.pgn.read_headers(pgn_file)
+                    if headers is None:
+                        break
+
+                    sides = player_filter.get_sides(headers)
+                    if not sides:
+                        # `read_headers` already skipped the movetext of this game
+                        n_skipped_games += 1
+                        pbar.update(pgn_file.tell() - game_offset)
+                        continue
+
+                    # Go back to the start of the game and parse it fully
+                    pgn_file.seek(game_offset)
+
                 game = chess.pgn.read_game(pgn_file)
                 if game is None:
                     break
 
                 board = chess.Board()
-                moves_uci = []
+                moves_packed = []
+                positions = []
                 white_player = game.headers.get("White", "Unknown")
                 black_player = game.headers.get("Black", "Unknown")
 
                 # Extract each move and corresponding game state
                 for move_number, move in enumerate(game.mainline_moves()):
-                    # Get current state before applying move
-                    game_state = board.fen()
-                    valid_moves = [str(legal_move) for legal_move in board.legal_moves]
-
                     # Determine which player is making the move
                     # White moves on even numbers, Black on odd
-                    current_player = (
-                        white_player if move_number % 2 == 0 else black_player
-                    )
-
-                    # Create data point for this position
-                    data_point = {
-                        "moves_uci": moves_uci.copy(),
-                        "last_5_moves_uci": moves_uci[-5:],
-                        "game_state": game_state,
-                        "valid_moves": valid_moves,
-                        "move_number": move_number,
-                        "game_id": game_id,
-                        "next_move": str(move),  # The actual move played
-                        "player_to_move": current_player,
-                    }
-                    extracted_data.append(data_point)
+                    color = chess.WHITE if move_number % 2 == 0 else chess.BLACK
+
+                    # Only the positions of the selected sides become data points
+                    if color in sides:
+                        current_player = (
+                            white_player if color == chess.WHITE else black_player
+                        )
+
+                        # Create data point for the state before applying move
+                        positions.append(
+                            {
+                                "game_id": game_id,
+                                "move_number": move_number,
+                                "game_state": board.fen(),
+                                "last_5_moves_packed": moves_packed[-5:],
+                                "valid_moves_packed": encode_moves(board.legal_moves),
+                                "next_move": str(move),  # The actual move played
+                                "player_to_move": current_player,
+                            }
+                        )
 
                     # Apply the move and add to move list
                     board.push(move)
-                    moves_uci.append(str(move))
+                    moves_packed.append(encode_move(move))
+
+                yield {
+                    "game_id": game_id,
+                    "white_player": white_player,
+                    "black_player": black_player,
+                    "moves_packed": moves_packed,
+                    "positions": positions,
+                }
 
                 game_id += 1
-                pbar.update(1)
+                pbar.update(pgn_file.tell() - game_offset)
+
+    if show_progress:
+        print(
+            f"Extracted {game_id - first_game_id} games, "
+            f"skipped {n_skipped_games} games"
+        )
+
+
+def split_pgn_file(pgn_file_path: str, shard_size: int) -> list[tuple[int, int]]:
+    """
+    Splits the PGN file into shards of roughly `shard_size` bytes.
+
+    Returns:
+        List of (start_offset, end_offset) byte ranges covering the whole file. Each
+        offset is a game boundary, so every game belongs to exactly one shard.
+    """
+    file_size = os.path.getsize(pgn_file_path)
+    boundaries = [0]
+
+    with open(pgn_file_path, "rb") as pgn_file:
+        for approximate_offset in range(shard_size, file_size, shard_size):
+            if approximate_offset <= boundaries[-1]:
+                continue
 
-    return extracted_data
+            offset = _find_next_game_boundary(pgn_file, approximate_offset)
+            if offset >= file_size:
+                break
+            boundaries.append(offset)
 
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:], strict=True))
 
-def save_dataset(data: list[dict[str, Any]], output_file: str):
-    """Save extracted data to JSON file."""
-    with open(output_file, "w") as f:
-        json.dump(data, f, indent=2)
-    print(f"Saved {len(data)} data points to {output_file}")
+
+def _find_next_game_boundary(pgn_file, offset: int) -> int:
+    """
+    Returns the first game boundary after `offset` in the binary `pgn_file`.
+
+    A game ends with the first empty line after its movetext, which is where
+    `chess.pgn.read_game` stops reading, so the boundary is placed right after it.
+    """
+    pgn_file.seek(offset)
+    # Skip the (possibly partial) line we landed on
+    pgn_file.readline()
+
+    in_movetext = False
+    while True:
+        line = pgn_file.readline()
+        if not line:
+            return pgn_file.tell()
+
+        if line.isspace():
+            if in_movetext:
+                return pgn_file.tell()
+        elif not line.startswith(b"["):
+            in_movetext = True
+
+
+def _extract_pgn_shard(
+    shard: tuple[str, int, int],
+    output_path: str,
+    player_filter: PlayerFilter | None,
+) -> int:
+    """
+    Runs in a worker process. Extracts the games of one shard of a PGN file into
+    the `output_path` Parquet files, and returns the number of games extracted.
+
+    Game ids start at 0 in every shard, and are renumbered when shards are merged.
+    """
+    pgn_file_path, start_offset, end_offset = shard
+    n_games, _ = save_dataset(
+        extract_game_data(
+            pgn_file_path,
+            player_filter=player_filter,
+            start_offset=start_offset,
+            end_offset=end_offset,
+            show_progress=False,
+        ),
+        output_path,
+        verbose=False,
+    )
+    return n_games
+
+
+def get_games_path(output_file: str) -> str:
+    """
+    Returns the path of the Parquet file with the games of the `output_file`
+    positions.
+    """
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.games{ext}"
+
+
+def save_dataset(
+    games: Iterable[dict[str, Any]],
+    output_file: str,
+    batch_size: int = 10_000,
+    verbose: bool = True,
+) -> tuple[int, int]:
+    """
+    Stream extracted games to Parquet files, one record batch at a time, so only
+    about `batch_size` positions are held in memory.
+
+    Positions are saved to `output_file` and games to `get_games_path(output_file)`.
+
+    Returns:
+        The number of games and positions saved
+    """
+    n_games = 0
+    n_positions = 0
+    game_rows = []
+    position_rows = []
+
+    with (
+        pq.ParquetWriter(output_file, POSITION_SCHEMA) as positions_writer,
+        pq.ParquetWriter(get_games_path(output_file), GAME_SCHEMA) as games_writer,
+    ):
+
+        def flush():
+            positions_writer.write_table(
+                pa.Table.from_pylist(position_rows, schema=POSITION_SCHEMA)
+            )
+            games_writer.write_table(
+                pa.Table.from_pylist(game_rows, schema=GAME_SCHEMA)
+            )
+            game_rows.clear()
+            position_rows.clear()
+
+        for game in games:
+            position_rows.extend(game.pop("positions"))
+            game_rows.append(game)
+
+            if len(position_rows) >= batch_size:
+                n_games += len(game_rows)
+                n_positions += len(position_rows)
+                flush()
+
+        n_games += len(game_rows)
+        n_positions += len(position_rows)
+        flush()
+
+    if verbose:
+        print(f"Saved {n_games} games and {n_positions} positions to {output_file}")
+
+    return n_games, n_positions
 
 
 def process_one_pgn_file(
     pgn_path: str,
     output_path: str,
-):
+    player_filter: PlayerFilter | None = None,
+    first_game_id: int = 0,
+) -> int:
     """
-    Extracts games from the given `pgn_path` and saves it into an `output_path` json
-    file
+    Extracts games from the given `pgn_path` and saves them into an `output_path`
+    Parquet file
+
+    Returns:
+        The number of games extracted
     """
     print(f"Extracting game data from {pgn_path}")
-    data = extract_game_data(pgn_path)
+    n_games, n_positions = save_dataset(
+        extract_game_data(
+            pgn_path, player_filter=player_filter, first_game_id=first_game_id
+        ),
+        output_path,
+    )
 
-    print(f"Extracted {len(data)} positions from games")
+    print(f"Extracted {n_positions} positions from games")
 
     # Show sample data point
-    if data:
+    if n_positions > 0:
+        sample = next(pq.ParquetFile(output_path).iter_batches(batch_size=1))
+        sample = decode_positions(sample.to_pydict())
         print("\nSample data point:")
-        print(json.dumps(data[0], indent=2))
+        print(
+            json.dumps({name: values[0] for name, values in sample.items()}, indent=2)
+        )
 
-    save_dataset(data, output_path)
+    return n_games
+
+
+def process_pgn_files_in_parallel(
+    pgn_files: list[str],
+    output_paths: list[str],
+    player_filter: PlayerFilter | None,
+    num_workers: int,
+    shard_size: int,
+):
+    """
+    Extracts games from all `pgn_files` using a pool of `num_workers` processes and
+    saves each of them into the corresponding `output_paths` Parquet file.
+
+    Large files are split into shards at game boundaries. Each worker writes its
+    shard to temporary Parquet files. Shards are then merged in file order, and
+    game ids are renumbered, so the output is the same as the one produced by
+    calling `process_one_pgn_file` on each file.
+    """
+    shards = []
+    shard_paths = []
+    for pgn_path, output_path in zip(pgn_files, output_paths, strict=True):
+        for i, (start_offset, end_offset) in enumerate(
+            split_pgn_file(pgn_path, shard_size)
+        ):
+            shards.append((pgn_path, start_offset, end_offset))
+            root, ext = os.path.splitext(output_path)
+            shard_paths.append(f"{root}.shard-{i:05d}{ext}")
+    print(f"Split {len(pgn_files)} PGN files into {len(shards)} shards")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        # `map` yields results in submission order, which keeps game ids stable
+        n_games_per_shard = list(
+            tqdm(
+                executor.map(
+                    _extract_pgn_shard,
+                    shards,
+                    shard_paths,
+                    [player_filter] * len(shards),
+                ),
+                total=len(shards),
+                desc="Processing PGN shards",
+            )
+        )
+
+    n_games = 0
+    for pgn_path, output_path in zip(pgn_files, output_paths, strict=True):
+        file_shards = [
+            (shard_path, n_shard_games)
+            for (shard_pgn_path, _, _), shard_path, n_shard_games in zip(
+                shards, shard_paths, n_games_per_shard, strict=True
+            )
+            if shard_pgn_path == pgn_path
+        ]
+
+        n_file_games = _merge_parquet_shards(
+            file_shards, output_path, POSITION_SCHEMA, first_game_id=n_games
+        )
+        _merge_parquet_shards(
+            [
+                (get_games_path(shard_path), n_shard_games)
+                for shard_path, n_shard_games in file_shards
+            ],
+            get_games_path(output_path),
+            GAME_SCHEMA,
+            first_game_id=n_games,
+        )
+
+        print(f"Extracted {n_file_games} games from {os.path.basename(pgn_path)}")
+        n_games += n_file_games
+
+
+def _merge_parquet_shards(
+    shards: list[tuple[str, int]],
+    output_path: str,
+    schema: pa.Schema,
+    first_game_id: int,
+) -> int:
+    """
+    Concatenates the (path, number of games) `shards` into `output_path`, batch by
+    batch, shifting their game ids so they start at `first_game_id`. The shard files
+    are deleted afterwards.
+
+    Returns:
+        The number of games in the merged file
+    """
+    game_id_offset = first_game_id
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for shard_path, n_shard_games in shards:
+            for batch in pq.ParquetFile(shard_path).iter_batches():
+                table = pa.Table.from_batches([batch])
+                game_ids = pc.add(table["game_id"], game_id_offset)
+                table = table.set_column(
+                    table.schema.get_field_index("game_id"), "game_id", game_ids
+                )
+                writer.write_table(table)
+
+            os.remove(shard_path)
+            game_id_offset += n_shard_games
+
+    return game_id_offset - first_game_id
 
 
 def generate_instruction_dataset(
     raw_data_dir: str | None = None,
     processed_data_dir: str | None = None,
     hugging_face_dataset_name: str | None = None,
+    player_name: str | None = "Carlsen",
+    player_color: str | None = None,
+    min_elo: int | None = None,
+    max_elo: int | None = None,
+    num_workers: int = 1,
+    shard_size_mb: int = 64,
 ):
     """
-    Process all PGN files in raw_data_dir, create processed JSON files,
+    Process all PGN files in raw_data_dir, create processed Parquet files,
     then combine into a HuggingFace dataset and push to hub.
+
+    Only positions where the player to move matches the `player_name` regex, plays
+    with `player_color` and has an Elo between `min_elo` and `max_elo` are extracted.
+    Games without any such position are not even parsed.
+
+    With `num_workers` > 1 the PGN files are split into shards of about
+    `shard_size_mb` megabytes and processed in parallel.
+
+    The positions are pushed as the default config of the dataset, and the games
+    (with all their moves) as the `games` config.
     """
     if raw_data_dir is None:
         script_path = Path(__file__).resolve()
@@ -133,50 +528,62 @@ def generate_instruction_dataset(
     # Ensure processed data directory exists
     os.makedirs(processed_data_dir, exist_ok=True)
 
-    # Find all PGN files in raw data directory
-    pgn_files = glob.glob(os.path.join(raw_data_dir, "*.pgn"))
+    # Find all PGN files in raw data directory, sorted so game ids are reproducible
+    pgn_files = sorted(glob.glob(os.path.join(raw_data_dir, "*.pgn")))
     print(
         f"Found {len(pgn_files)} PGN files: {[os.path.basename(f) for f in pgn_files]}"
     )
 
-    # Process each PGN file
-    processed_files = []
-    for pgn_path in tqdm(pgn_files, desc="Processing PGN files"):
-        filename = os.path.splitext(os.path.basename(pgn_path))[0]
-        output_path = os.path.join(processed_data_dir, f"{filename}.json")
-
-        print(f"\nProcessing {os.path.basename(pgn_path)}...")
-        process_one_pgn_file(pgn_path, output_path)
-        processed_files.append(output_path)
-
-        # TODO: remove this
-        # break
-
-    # Load all processed data
-    all_data = []
-    for json_path in processed_files:
-        print(f"Loading {os.path.basename(json_path)}...")
-        with open(json_path) as f:
-            data = json.load(f)
-            all_data.extend(data)
-
-    print(f"\nTotal data points before filtering: {len(all_data)}")
-
-    # Filter to keep only positions where Magnus Carlsen is the player to move
-    carlsen_data = [
-        point for point in all_data if "Carlsen" in point.get("player_to_move", "")
+    player_filter = PlayerFilter(
+        name=player_name, color=player_color, min_elo=min_elo, max_elo=max_elo
+    )
+    print(f"Extracting positions for {player_filter}")
+
+    processed_files = [
+        os.path.join(
+            processed_data_dir,
+            f"{os.path.splitext(os.path.basename(pgn_path))[0]}.parquet",
+        )
+        for pgn_path in pgn_files
     ]
-    print(f"Data points with Carlsen to move: {len(carlsen_data)}")
 
-    all_data = carlsen_data
-
-    # Create HuggingFace dataset
-    dataset = Dataset.from_list(all_data)
+    if num_workers > 1:
+        process_pgn_files_in_parallel(
+            pgn_files,
+            processed_files,
+            player_filter=player_filter,
+            num_workers=num_workers,
+            shard_size=shard_size_mb * 1024 * 1024,
+        )
+    else:
+        # Process each PGN file. Game ids keep counting across files, so they are
+        # unique in the whole dataset.
+        n_games = 0
+        for pgn_path, output_path in tqdm(
+            zip(pgn_files, processed_files, strict=True),
+            total=len(pgn_files),
+            desc="Processing PGN files",
+        ):
+            print(f"\nProcessing {os.path.basename(pgn_path)}...")
+            n_games += process_one_pgn_file(
+                pgn_path,
+                output_path,
+                player_filter=player_filter,
+                first_game_id=n_games,
+            )
+
+    # Build the dataset from the Parquet files. `datasets` converts them to a memory
+    # mapped Arrow table, so the data points are never all loaded in memory.
+    dataset = Dataset.from_parquet(processed_files)
+    games_dataset = Dataset.from_parquet(
+        [get_games_path(path) for path in processed_files]
+    )
     print(f"Created dataset with {len(dataset)} samples")
 
     # Push to hub
     print(f"Pushing dataset to HuggingFace Hub: {hugging_face_dataset_name}")
     dataset.push_to_hub(hugging_face_dataset_name)
+    games_dataset.push_to_hub(hugging_face_dataset_name, config_name="games")
     print("Dataset successfully pushed to hub!")
 
 
@@ -1,19 +1,38 @@
+import copy
+import random
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
+import modal
+import numpy as np
+import torch
+from peft import get_peft_model_state_dict
+from safetensors.torch import save_file
+from transformers import TrainerCallback
 
-def check_for_existing_checkpoint(paths: dict):
+
+def check_for_existing_checkpoint(checkpoint_dir: Path) -> str | None:
     """
     Check if there's an existing checkpoint to resume training from.
 
     This enables resumable training, which is crucial for long-running experiments
     that might be interrupted by infrastructure issues or resource limits.
+
+    Only complete checkpoints are considered: the Trainer writes
+    `trainer_state.json` after the model, optimizer, scheduler and RNG states, so a
+    checkpoint without it was interrupted while being saved.
     """
-    checkpoint_dir = paths["checkpoints"]
     if not checkpoint_dir.exists():
         return None
 
     # Look for the most recent checkpoint directory
-    checkpoints = list(checkpoint_dir.glob("checkpoint-*"))
+    checkpoints = [
+        path
+        for path in checkpoint_dir.glob("checkpoint-*")
+        if (path / "trainer_state.json").exists()
+    ]
     if checkpoints:
         latest_checkpoint = max(checkpoints, key=lambda p: int(p.name.split("-")[1]))
         print(f"Found existing checkpoint: {latest_checkpoint}")
@@ -22,6 +41,205 @@ def check_for_existing_checkpoint(paths: dict):
     return None
 
 
+class VolumeCommitCallback(TrainerCallback):
+    """
+    Commits the Modal volume the checkpoints are written to after every save, so a
+    preempted container loses at most `save_steps` of training.
+    """
+
+    def __init__(self, volume: modal.Volume):
+        self.volume = volume
+
+    def on_save(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            print(f"Commiting checkpoint-{state.global_step} to {self.volume}")
+            self.volume.commit()
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """
+    Saves a checkpoint every `save_steps` without stalling training, in place of the
+    checkpoints of the Trainer (`save_strategy="no"`).
+
+    On the training thread, the LoRA adapter, optimizer, scheduler, RNG and trainer
+    states are only copied to host memory. A background thread writes them in the
+    layout of the Trainer checkpoints, so training can resume from them, deletes
+    the checkpoints the retention policy does not keep and commits the volume.
+
+    Only the adapter weights are stored, never the weights of the base model.
+    """
+
+    def __init__(
+        self,
+        checkpoint_dir: Path,
+        volume: modal.Volume,
+        save_steps: int,
+        keep_last: int | None = None,
+        metric_for_best_checkpoint: str = "eval_loss",
+        greater_is_better: bool = False,
+    ):
+        """
+        Args:
+            checkpoint_dir: Directory of the training run
+            keep_last: Number of most recent checkpoints kept, plus the best one by
+                `metric_for_best_checkpoint`. None keeps every checkpoint.
+            metric_for_best_checkpoint: Evaluation metric the best checkpoint is
+                chosen by
+        """
+        if keep_last is not None and keep_last < 1:
+            raise ValueError("keep_last must be at least 1")
+
+        self.checkpoint_dir = checkpoint_dir
+        self.volume = volume
+        self.save_steps = save_steps
+        self.keep_last = keep_last
+        if not metric_for_best_checkpoint.startswith("eval_"):
+            metric_for_best_checkpoint = f"eval_{metric_for_best_checkpoint}"
+        self.metric_for_best_checkpoint = metric_for_best_checkpoint
+        self.greater_is_better = greater_is_better
+
+        # A single writer, so checkpoints are written in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_write: Future | None = None
+        # Value of the metric at each evaluated step, also read by the writer
+        self._metrics: dict[int, float] = {}
+        self._metrics_lock = threading.Lock()
+
+    def on_step_end(
+        self,
+        args,
+        state,
+        control,
+        model=None,
+        optimizer=None,
+        lr_scheduler=None,
+        **kwargs,
+    ):
+        is_save_step = state.global_step % self.save_steps == 0
+        if not state.is_world_process_zero or not (
+            is_save_step or state.global_step >= state.max_steps
+        ):
+            return
+
+        # Raises the errors of the previous write, and keeps at most one snapshot
+        # waiting in host memory if writing is slower than training
+        self._wait_for_pending_write()
+
+        peft_config = copy.deepcopy(model.peft_config[model.active_adapter])
+        peft_config.inference_mode = True
+        snapshot = {
+            "adapter": _to_cpu(
+                get_peft_model_state_dict(model, save_embedding_layers=False)
+            ),
+            "peft_config": peft_config,
+            "optimizer": _to_cpu(optimizer.state_dict()),
+            "scheduler": copy.deepcopy(lr_scheduler.state_dict()),
+            "rng_state": _get_rng_state(),
+            "trainer_state": copy.deepcopy(state),
+        }
+        self._pending_write = self._executor.submit(
+            self._write_checkpoint, state.global_step, snapshot
+        )
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        if metrics and self.metric_for_best_checkpoint in metrics:
+            with self._metrics_lock:
+                self._metrics[state.global_step] = metrics[
+                    self.metric_for_best_checkpoint
+                ]
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self._wait_for_pending_write()
+        self._executor.shutdown()
+
+    def _wait_for_pending_write(self):
+        if self._pending_write is not None:
+            self._pending_write.result()
+            self._pending_write = None
+
+    def _write_checkpoint(self, step: int, snapshot: dict):
+        # Written under another name and renamed once complete, so an interrupted
+        # write never looks like a checkpoint to resume from
+        path = self.checkpoint_dir / f"checkpoint-{step}"
+        tmp_path = self.checkpoint_dir / f"tmp-checkpoint-{step}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        save_file(
+            snapshot["adapter"],
+            tmp_path / "adapter_model.safetensors",
+            metadata={"format": "pt"},
+        )
+        snapshot["peft_config"].save_pretrained(tmp_path)
+        torch.save(snapshot["optimizer"], tmp_path / "optimizer.pt")
+        torch.save(snapshot["scheduler"], tmp_path / "scheduler.pt")
+        torch.save(snapshot["rng_state"], tmp_path / "rng_state.pth")
+        snapshot["trainer_state"].save_to_json(str(tmp_path / "trainer_state.json"))
+
+        shutil.rmtree(path, ignore_errors=True)
+        tmp_path.rename(path)
+        print(f"Saved {path}")
+
+        self._delete_old_checkpoints()
+        self.volume.commit()
+
+    def _delete_old_checkpoints(self):
+        """
+        Deletes every checkpoint but the `keep_last` most recent ones and the best
+        one among the evaluated ones.
+        """
+        if self.keep_last is None:
+            return
+
+        checkpoints = sorted(
+            self.checkpoint_dir.glob("checkpoint-*"),
+            key=lambda p: int(p.name.split("-")[1]),
+        )
+        keep = set(checkpoints[-self.keep_last :])
+
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        evaluated = [p for p in checkpoints if int(p.name.split("-")[1]) in metrics]
+        if evaluated:
+            select_best = max if self.greater_is_better else min
+            keep.add(
+                select_best(evaluated, key=lambda p: metrics[int(p.name.split("-")[1])])
+            )
+
+        for path in checkpoints:
+            if path not in keep:
+                print(f"Deleting {path}")
+                shutil.rmtree(path)
+
+
+def _to_cpu(obj):
+    """
+    Returns a copy of `obj` with all its tensors copied to host memory.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, list | tuple):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def _get_rng_state() -> dict:
+    """
+    Returns the RNG states in the format of the `rng_state.pth` of the Trainer
+    checkpoints (single process).
+    """
+    rng_state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "cpu": torch.random.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.random.get_rng_state()
+    return rng_state
+
+
 def _get_or_create_path_to_model_checkpoints(
     wandb_experiment_name: str,
 ) -> Path:
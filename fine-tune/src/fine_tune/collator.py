@@ -0,0 +1,157 @@
+"""
+Collators for the pre-tokenized SFT datasets.
+
+Instead of padding every example of a batch to the longest one, the examples are
+concatenated into a single row, and `position_ids` restart at 0 at the beginning of
+each of them. The attention implementations of transformers find the boundaries of
+the examples in the `position_ids` (flash attention natively, sdpa and eager through
+a block-diagonal causal mask), so tokens never attend to another example. Layers
+that ignore the `position_ids`, like the convolutions of LFM2, would still mix the
+examples, so such models are refused (see `trainer._check_padding_free_support`).
+
+Our prompts are a few hundred tokens and the answers a few, so batches of examples
+of different lengths waste a large share of their tokens on padding otherwise.
+
+For the same reason, almost all the logits of an example are computed for prompt
+tokens that are masked out of the loss. With `completion_only_logits`, the collator
+also passes the model the positions the loss needs (`logits_to_keep`), so the LM
+head only runs on them, and the labels of those positions alone, already shifted.
+The loss is then computed by `compute_completion_loss`.
+
+Models that cannot be trained padding-free, like LFM2, get the same savings from
+`CompletionOnlyCollator`: examples are left-padded, so every answer ends at the
+last column of the batch, and the LM head runs on the last columns only.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+class PaddingFreeCollator:
+    def __init__(
+        self, assistant_only_loss: bool = False, completion_only_logits: bool = False
+    ):
+        """
+        Args:
+            assistant_only_loss: Compute the loss only on the tokens of the assistant
+                answer, given by the `assistant_masks` of the examples
+            completion_only_logits: Compute the logits only at the positions that
+                predict a token of the loss
+        """
+        self.assistant_only_loss = assistant_only_loss
+        self.completion_only_logits = completion_only_logits
+
+    def __call__(self, examples: list[dict]) -> dict[str, torch.Tensor]:
+        input_ids, position_ids, labels = [], [], []
+        for example in examples:
+            example_input_ids = list(example["input_ids"])
+            example_labels = list(example_input_ids)
+            if self.assistant_only_loss:
+                example_labels = [
+                    label if mask else -100
+                    for label, mask in zip(
+                        example_labels, example["assistant_masks"], strict=True
+                    )
+                ]
+            # Labels are shifted inside the model, so the label of the first token
+            # would be predicted from the last token of the previous example
+            example_labels[0] = -100
+
+            input_ids += example_input_ids
+            position_ids += range(len(example_input_ids))
+            labels += example_labels
+
+        batch = {
+            "input_ids": torch.tensor([input_ids], dtype=torch.long),
+            "position_ids": torch.tensor([position_ids], dtype=torch.long),
+        }
+        if not self.completion_only_logits:
+            batch["labels"] = torch.tensor([labels], dtype=torch.long)
+            return batch
+
+        # The logits at position i predict the token at position i + 1
+        positions = [i for i in range(len(labels) - 1) if labels[i + 1] != -100]
+        shifted_labels = [labels[i + 1] for i in positions]
+        if not positions:
+            # Every answer was truncated away: keep one ignored position, so the loss
+            # is 0 instead of the mean of nothing
+            positions, shifted_labels = [len(labels) - 1], [-100]
+
+        batch["logits_to_keep"] = torch.tensor(positions, dtype=torch.long)
+        batch["labels"] = torch.tensor([shifted_labels], dtype=torch.long)
+        return batch
+
+
+def compute_completion_loss(
+    outputs, labels: torch.Tensor, num_items_in_batch: int | None = None
+) -> torch.Tensor:
+    """
+    Cross-entropy of the logits computed at the `logits_to_keep` positions only,
+    against the shifted labels of those positions (see `PaddingFreeCollator` and
+    `CompletionOnlyCollator`).
+
+    Has the signature of the `compute_loss_func` of `transformers.Trainer`, which
+    counts `num_items_in_batch` over all the gradient accumulation steps.
+    """
+    logits = outputs.logits.float()
+    loss = F.cross_entropy(
+        logits.reshape(-1, logits.shape[-1]),
+        labels.reshape(-1).to(logits.device),
+        ignore_index=-100,
+        reduction="sum",
+    )
+    if num_items_in_batch is None:
+        num_items_in_batch = labels.ne(-100).sum()
+    if torch.is_tensor(num_items_in_batch):
+        num_items_in_batch = num_items_in_batch.to(loss.device)
+    return loss / max(num_items_in_batch, 1)
+
+
+class CompletionOnlyCollator:
+    def __init__(self, pad_token_id: int):
+        """
+        Left-pads the examples of a batch and keeps the logits of the last columns
+        only, as many as the longest answer needs (see `compute_completion_loss`).
+
+        The answer tokens are the last ones of each example, given by its
+        `assistant_masks`, so with left padding they line up at the end of the
+        rows, whatever the length of the prompts.
+
+        Args:
+            pad_token_id: Token id of the padding, masked out by the attention mask
+        """
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, examples: list[dict]) -> dict[str, torch.Tensor]:
+        n_columns = max(len(example["input_ids"]) for example in examples)
+        # The logits of the last column predict nothing, and each answer token is
+        # predicted by the column before it
+        logits_to_keep = 1 + max(
+            sum(example["assistant_masks"]) for example in examples
+        )
+
+        input_ids, attention_mask, position_ids, labels = [], [], [], []
+        for example in examples:
+            example_input_ids = list(example["input_ids"])
+            n_padding = n_columns - len(example_input_ids)
+            row_labels = [-100] * n_padding + [
+                input_id if mask else -100
+                for input_id, mask in zip(
+                    example_input_ids, example["assistant_masks"], strict=True
+                )
+            ]
+
+            input_ids.append([self.pad_token_id] * n_padding + example_input_ids)
+            attention_mask.append([0] * n_padding + [1] * len(example_input_ids))
+            # Positions start at 0 at the first token of the example, not of the row
+            position_ids.append([0] * n_padding + list(range(len(example_input_ids))))
+            # The logits at column i predict the token at column i + 1
+            labels.append(row_labels[n_columns - logits_to_keep + 1 :] + [-100])
+
+        return {
+            "input_ids": torch.tensor(input_ids, dtype=torch.long),
+            "attention_mask": torch.tensor(attention_mask, dtype=torch.long),
+            "position_ids": torch.tensor(position_ids, dtype=torch.long),
+            "logits_to_keep": logits_to_keep,
+            "labels": torch.tensor(labels, dtype=torch.long),
+        }
@@ -1,8 +1,10 @@
 from datetime import datetime
 
-from pydantic import model_validator
+from pydantic import field_validator, model_validator
 from pydantic_settings import BaseSettings
 
+from .prompt_template import check_prompt_format
+
 
 class TrainingJobConfig(BaseSettings):
     # Model configuration
@@ -21,6 +23,9 @@ class TrainingJobConfig(BaseSettings):
     dataset_conversations_field: str = "conversations"
     dataset_text_field: str = "text"
     invalidate_dataset_cache: bool = False
+    prompt_format: str = "default"  # see fine_tune.prompt_template.PROMPT_FORMATS
+    dataset_cache_max_entries: int = 10
+    dataset_cache_max_size_gb: float = 50.0
 
     # LoRA-specific hyperparameters
     lora_r: int = 16
@@ -43,6 +48,10 @@ class TrainingJobConfig(BaseSettings):
     batch_size: int = 16
     gradient_accumulation_steps: int = 1
     packing: bool = False
+    assistant_only_loss: bool = False  # compute the loss only on the assistant answer
+    group_by_length: bool = False  # batch examples of similar length together
+    padding_free: bool = False  # concatenate each batch into one row, no padding
+    completion_only_logits: bool = False  # LM head only on the answer tokens
     use_gradient_checkpointing: str = (
         "unsloth"  # unsloth: optimized gradient offloading
     )
@@ -52,9 +61,16 @@ class TrainingJobConfig(BaseSettings):
     weight_decay: float = 0.01
     max_steps: int = 10000  # increase!
     save_steps: int = 1000  # increase!
+    async_checkpointing: bool = False  # write checkpoints from a background thread
+    checkpoints_keep_last: int | None = None  # None keeps every checkpoint
+    metric_for_best_checkpoint: str = "eval_loss"  # kept on top of the last ones
+    greater_is_better: bool = False  # for metric_for_best_checkpoint
     eval_steps: int = 1000  # increase!
     logging_steps: int = 10  # increase!
-    eval_sample_callback_enabled: bool = False
+    eval_sample_callback_enabled: bool = False  # playing strength at each eval
+    eval_sample_positions: int = 256  # positions to predict the next move of
+    eval_sample_games: int = 8  # games against a RandomPlayer
+    eval_sample_max_plies: int = 100  # games are drawn after this many moves
 
     # Modal configuration
     modal_app_name: str = "finetune-chess-llm"
@@ -73,6 +89,12 @@ class TrainingJobConfig(BaseSettings):
     skip_eval: bool = False
     output_dir: str = "outputs"
 
+    @field_validator("prompt_format")
+    @classmethod
+    def validate_prompt_format(cls, prompt_format: str) -> str:
+        check_prompt_format(prompt_format)
+        return prompt_format
+
     @model_validator(mode="after")
     def set_experiment_name(self):
         if self.wandb_experiment_name is None:
@@ -80,4 +102,4 @@ class TrainingJobConfig(BaseSettings):
             model_short = self.model_name.split("/")[-1]
             self.wandb_experiment_name = f"{model_short}-r{self.lora_r}-{timestamp}"
 
-        return self
\ No newline at end of file
+        return self
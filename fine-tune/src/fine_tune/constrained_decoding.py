@@ -0,0 +1,89 @@
+"""
+Constrained decoding of chess moves.
+
+The tokens of the legal moves of a position are stored in a prefix trie, and a
+logits processor masks, at every generation step, all the tokens that would not
+extend the text generated so far into one of them. Once a complete move has been
+generated, only the end-of-sequence tokens are allowed, so generation stops after
+the few tokens of a single legal move.
+"""
+
+import torch
+from transformers import LogitsProcessor
+
+
+class MoveTrie:
+    """
+    Prefix trie of the token ids of a set of moves.
+    """
+
+    def __init__(self, moves_token_ids: dict[str, list[int]]):
+        """
+        Args:
+            moves_token_ids: Token ids of each move, e.g. {"e2e4": [68, 17, 68, 19]}
+        """
+        self.root: dict = {}
+        self.depth = 0
+        for move, token_ids in moves_token_ids.items():
+            node = self.root
+            for token_id in token_ids:
+                node = node.setdefault(token_id, {})
+            # The None key marks the end of a complete move
+            node[None] = move
+            self.depth = max(self.depth, len(token_ids))
+
+    def get_next_token_ids(
+        self, token_ids: list[int], eos_token_ids: list[int]
+    ) -> list[int]:
+        """
+        Returns the tokens allowed after the generated `token_ids`: the ones that
+        continue a move, plus the `eos_token_ids` if `token_ids` is a complete move.
+
+        If `token_ids` leaves the trie, the sequence has already ended (it is
+        followed by padding), and only the `eos_token_ids` are returned.
+        """
+        node = self.root
+        for token_id in token_ids:
+            if token_id not in node:
+                return eos_token_ids
+            node = node[token_id]
+
+        next_token_ids = [token_id for token_id in node if token_id is not None]
+        if None in node:
+            next_token_ids += eos_token_ids
+        return next_token_ids
+
+
+class LegalMovesLogitsProcessor(LogitsProcessor):
+    """
+    Restricts the generation of each sequence of the batch to the moves of its trie.
+    """
+
+    def __init__(
+        self,
+        tries: list[MoveTrie],
+        prompt_length: int,
+        eos_token_ids: list[int],
+    ):
+        """
+        Args:
+            tries: One trie per sequence in the batch
+            prompt_length: Length of the (left padded) prompts, where the generated
+                tokens start
+            eos_token_ids: Tokens that end the generation
+        """
+        self.tries = tries
+        self.prompt_length = prompt_length
+        self.eos_token_ids = eos_token_ids
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        mask = torch.full_like(scores, float("-inf"))
+        generated_token_ids = input_ids[:, self.prompt_length :].tolist()
+        for row, (trie, token_ids) in enumerate(
+            zip(self.tries, generated_token_ids, strict=True)
+        ):
+            next_token_ids = trie.get_next_token_ids(token_ids, self.eos_token_ids)
+            mask[row, next_token_ids] = 0.0
+        return scores + mask
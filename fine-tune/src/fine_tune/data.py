@@ -1,12 +1,19 @@
+import hashlib
+import json
 from pathlib import Path
 
 import datasets
 import modal
 
 from .config import TrainingJobConfig
+from .dataset_cache import DatasetCache
+from .encoding import decode_positions, is_compact_dataset
 
 # from transformers import AutoTokenizer
-from .prompt_template import get_prompt
+from .prompt_template import get_prompt_template_version, get_prompts
+
+# Bump it when the preprocessing code changes the cached datasets
+PREPROCESSING_VERSION = 1
 
 
 def prepare_datasets(
@@ -16,68 +23,72 @@ def prepare_datasets(
 ):
     # import datasets
 
-    # Get path of cache datasets generate in a previous run using the same
-    # `dataset_name`, `train_split_ratio` and `seed`
-    dataset_cache_path = _get_path_to_cached_datasets(
-        dataset_name=config.dataset_name,
-        train_split_ratio=config.train_split_ratio,
-        seed=config.seed,
+    # The cache key covers every input of the preprocessing below, so a cached
+    # version is only reused when it was built exactly the same way
+    cache_inputs = get_preprocessing_inputs(config, tokenizer)
+    cache_key = DatasetCache.get_key(cache_inputs)
+    dataset_cache = DatasetCache(
+        root=Path("/datasets"),
+        max_entries=config.dataset_cache_max_entries,
+        max_size_gb=config.dataset_cache_max_size_gb,
+        volume=datasets_volume,
     )
+    print(f"Dataset cache key {cache_key} for {cache_inputs}")
+
+    train_dataset, eval_dataset = None, None
+    if not config.invalidate_dataset_cache:
+        train_dataset, eval_dataset = dataset_cache.load(cache_key)
 
-    if dataset_cache_path.exists() and not config.invalidate_dataset_cache:
-        print(f"Loading train/eval cached datasets from {dataset_cache_path}")
-        train_dataset = datasets.load_from_disk(dataset_cache_path / "train")
-        eval_dataset = datasets.load_from_disk(dataset_cache_path / "eval")
-    else:
+    if train_dataset is None:
         print(f"Downloading and processing dataset: {config.dataset_name}")
 
         # Load and standardize the dataset format
-        dataset = datasets.load_dataset(config.dataset_name, split="train")
+        dataset = datasets.load_dataset(
+            config.dataset_name,
+            split="train",
+            revision=cache_inputs["dataset_revision"],
+        )
         print(f"Dataset {config.dataset_name} has {len(dataset)} examples.")
 
         if config.dataset_samples is not None:
             dataset = dataset.select(range(config.dataset_samples))
             print(f"Selected {config.dataset_samples} samples for training.")
 
-        print("Converting instructions to conversation format...")
-        # dataset = dataset.map(_convert_to_openai_conversation_format)
-        # dataset = convert_dataset_to_conversation_format(
-        #   dataset, config.prompt_template_file)
-        dataset = dataset.map(convert_to_conversation_format)
-
-        print("Sample conversations before applying chat templates:")
-        for i in range(5):
-            print(f"Sample {i}: {dataset[i]['conversations']}")
-            print("--------")
-
-        print("Applying chat templates to conversations...")
+        # Build the conversations, apply the chat template and tokenize them in a
+        # single batched pass, so the intermediate conversations are never written
+        # to the dataset. The cached token ids let `SFTTrainer` skip tokenization.
+        print("Converting instructions to tokenized chat-templated conversations...")
         dataset = dataset.map(
-            lambda examples: apply_chat_template(examples, tokenizer),
+            lambda examples: tokenize_conversations(
+                examples, tokenizer, config.max_seq_length, config.prompt_format
+            ),
             batched=True,
             num_proc=config.preprocessing_workers,
             remove_columns=dataset.column_names,
         )
 
+        lengths = dataset["length"]
+        print(
+            f"Token lengths: mean={sum(lengths) / len(lengths):.1f} "
+            f"max={max(lengths)} (max_seq_length={config.max_seq_length})"
+        )
+
         print("Sample conversations after applying chat templates:")
         for i in range(5):
             print(f"Sample {i}: {dataset[i]['text']}")
             print("--------")
 
         print("Splitting dataset into train and eval sets...")
-        dataset = dataset.train_test_split(
-            test_size=1.0 - config.train_split_ratio, seed=config.seed
-        )
+        dataset = split_dataset(dataset, config)
         train_dataset = dataset["train"]
         eval_dataset = dataset["test"]
 
-        print(f"Caching processed datasets to {dataset_cache_path}")
-        dataset_cache_path.mkdir(parents=True, exist_ok=True)
-        train_dataset.save_to_disk(dataset_cache_path / "train")
-        eval_dataset.save_to_disk(dataset_cache_path / "eval")
+        dataset_cache.save(cache_key, cache_inputs, train_dataset, eval_dataset)
 
-        print(f"Commiting write operation to {datasets_volume}")
-        datasets_volume.commit()
-        print(f"Commited write operation to {datasets_volume}")
+    # Persist new entries, evictions and the manifest (which also tracks usage)
+    print(f"Commiting write operation to {datasets_volume}")
+    datasets_volume.commit()
+    print(f"Commited write operation to {datasets_volume}")
 
     print("Printing 5 first samples from the training dataset...")
     for i in range(5):
@@ -88,48 +99,150 @@ def prepare_datasets(
     return train_dataset, eval_dataset
 
 
-def _get_path_to_cached_datasets(
-    dataset_name: str,
-    train_split_ratio: float,
-    seed: int,
-) -> Path:
+def split_dataset(
+    dataset: datasets.Dataset, config: TrainingJobConfig
+) -> datasets.DatasetDict:
+    """
+    Splits the sampled dataset into a "train" and a "test" (eval) set.
+
+    The split only depends on the number of examples and the seed, so the raw
+    dataset is split the same way as the tokenized one, see `get_eval_positions`.
+    """
+    return dataset.train_test_split(
+        test_size=1.0 - config.train_split_ratio, seed=config.seed
+    )
+
+
+def get_preprocessing_inputs(
+    config: TrainingJobConfig,
+    tokenizer: "AutoTokenizer",
+) -> dict:
+    """
+    Returns every input that determines the output of `prepare_datasets`.
+    """
+    return {
+        "preprocessing_version": PREPROCESSING_VERSION,
+        "dataset_name": config.dataset_name,
+        "dataset_revision": _get_dataset_revision(config.dataset_name),
+        "dataset_samples": config.dataset_samples,
+        "train_split_ratio": config.train_split_ratio,
+        "seed": config.seed,
+        "tokenizer": get_tokenizer_hash(tokenizer),
+        "max_seq_length": config.max_seq_length,
+        # Also identifies the prompt format
+        "prompt_template_version": get_prompt_template_version(config.prompt_format),
+    }
+
+
+def _get_dataset_revision(dataset_name: str) -> str | None:
+    """
+    Returns the commit hash of the dataset on the Hugging Face Hub, so a new push
+    of the dataset invalidates the cache.
+    """
+    from huggingface_hub import HfApi
+
+    try:
+        return HfApi().dataset_info(dataset_name).sha
+    except Exception as e:
+        print(f"Could not get the revision of {dataset_name}: {e}")
+        return None
+
+
+def get_tokenizer_hash(tokenizer) -> str:
     """
-    Returns path to the cached dataset in a Modal volume.
+    Returns a short hash identifying how `tokenizer` turns conversations into token
+    ids: its name, vocabulary size, special tokens and chat template.
     """
-    return (
-        Path("/datasets")
-        / dataset_name.replace("/", "--")
-        / f"train-{train_split_ratio}-seed-{seed}"
+    fingerprint = json.dumps(
+        {
+            "name": tokenizer.name_or_path,
+            "vocab_size": len(tokenizer),
+            "special_tokens": tokenizer.special_tokens_map,
+            "chat_template": tokenizer.chat_template,
+        },
+        sort_keys=True,
+        default=str,
     )
+    return hashlib.sha256(fingerprint.encode()).hexdigest()[:12]
 
 
-def convert_to_conversation_format(example: dict) -> dict:
-    # data = {
-    #     'player_to_move': example["player_to_move"],
-    #     'game_state': example["game_state"],
-    #     'last_5_moves_uci': example["last_5_moves_uci"],
-    #     'valid_moves': example["valid_moves"],
-    # }
-    prompt = get_prompt(
-        # player_to_move=example["player_to_move"],
-        game_state=example["game_state"],
-        last_5_moves_uci=example["last_5_moves_uci"],
-        valid_moves=example["valid_moves"],
+def convert_to_conversations(
+    examples: dict, prompt_format: str = "default"
+) -> list[list[dict]]:
+    """
+    Builds the user prompt and assistant answer conversation of each example of a
+    batch.
+    """
+    prompts = get_prompts(
+        game_states=examples["game_state"],
+        last_5_moves_uci=examples["last_5_moves_uci"],
+        valid_moves=examples["valid_moves"],
+        prompt_format=prompt_format,
     )
 
-    return {
-        "conversations": [
+    return [
+        [
             {"role": "user", "content": prompt},
-            {"role": "assistant", "content": example["next_move"]},
+            {"role": "assistant", "content": next_move},
         ]
-    }
+        for prompt, next_move in zip(prompts, examples["next_move"], strict=True)
+    ]
 
 
-def apply_chat_template(examples, tokenizer):
-    texts = []
-    for conversation in examples["conversations"]:
-        formatted_text = tokenizer.apply_chat_template(
+def tokenize_conversations(
+    examples: dict, tokenizer, max_seq_length: int, prompt_format: str = "default"
+) -> dict:
+    """
+    Converts a batch of examples to conversations, applies the chat template to them
+    and tokenizes the chat-templated texts. This is the only preprocessing of the
+    training and eval datasets.
+
+    Datasets with packed moves are decoded first (see `encoding.py`).
+
+    Returns the columns:
+    - text: the chat-templated conversation
+    - input_ids, attention_mask: its tokens, truncated to `max_seq_length`
+    - assistant_masks: 1 for the tokens of the assistant answer, the only ones the
+      loss should be computed on, and 0 for the prompt tokens
+    - length: the number of tokens, for length-aware batching
+    """
+    if is_compact_dataset(list(examples.keys())):
+        examples = decode_positions(examples)
+
+    columns = {
+        "text": [],
+        "input_ids": [],
+        "attention_mask": [],
+        "assistant_masks": [],
+        "length": [],
+    }
+    for conversation in convert_to_conversations(examples, prompt_format):
+        text = tokenizer.apply_chat_template(
             conversation, tokenize=False, add_generation_prompt=False
         )
-        texts.append(formatted_text)
-    return {"text": texts}
+        prompt_text = tokenizer.apply_chat_template(
+            conversation[:1], tokenize=False, add_generation_prompt=True
+        )
+        if not text.startswith(prompt_text):
+            raise ValueError(
+                "The chat template renders the prompt differently with and without "
+                "the assistant answer, so the answer tokens cannot be located."
+            )
+
+        # The chat template already adds the special tokens
+        input_ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        n_prompt_tokens = len(
+            tokenizer(prompt_text, add_special_tokens=False)["input_ids"]
+        )
+        input_ids = input_ids[:max_seq_length]
+        n_prompt_tokens = min(n_prompt_tokens, len(input_ids))
+
+        columns["text"].append(text)
+        columns["input_ids"].append(input_ids)
+        columns["attention_mask"].append([1] * len(input_ids))
+        columns["assistant_masks"].append(
+            [0] * n_prompt_tokens + [1] * (len(input_ids) - n_prompt_tokens)
+        )
+        columns["length"].append(len(input_ids))
+
+    return columns
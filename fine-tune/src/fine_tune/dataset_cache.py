@@ -0,0 +1,214 @@
+"""
+Content-addressed cache of preprocessed train/eval datasets.
+
+Each cache entry lives in its own directory under `<root>/cache/<key>`, where the
+key is a hash of every input of the preprocessing (dataset, sampling, split,
+tokenizer, prompt template...). Several entries are kept side by side, so switching
+between experiments never forces a full reprocess, and the least recently used
+entries are evicted when the cache grows past its limits.
+
+A `manifest.json` file at the root of the cache records, for each entry, the inputs
+that produced it, its size and when it was created and last used. Several training
+runs, in different Modal containers, can share the cache, so the volume is reloaded
+and the manifest re-read and merged right before every write, and committed right
+after, see `_update_manifest`.
+"""
+
+import hashlib
+import json
+import shutil
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import datasets
+import modal
+
+
+class DatasetCache:
+    def __init__(
+        self,
+        root: Path = Path("/datasets"),
+        max_entries: int | None = None,
+        max_size_gb: float | None = None,
+        volume: modal.Volume | None = None,
+    ):
+        """
+        Args:
+            root: Directory of the cache
+            max_entries, max_size_gb: Limits of the cache, see `evict`
+            volume: Modal volume mounted at `root`, synced around every manifest
+                update so runs in other containers see each other's entries
+        """
+        self.root = root
+        self.max_entries = max_entries
+        self.max_size_gb = max_size_gb
+        self.volume = volume
+
+    @staticmethod
+    def get_key(inputs: dict) -> str:
+        """
+        Returns the cache key for the given preprocessing `inputs`.
+        """
+        serialized_inputs = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(serialized_inputs.encode()).hexdigest()[:16]
+
+    def get_path(self, key: str) -> Path:
+        return self.root / "cache" / key
+
+    def load(
+        self, key: str
+    ) -> tuple[datasets.Dataset, datasets.Dataset] | tuple[None, None]:
+        """
+        Returns the cached train and eval datasets for `key`, or (None, None) if
+        they are not in the cache.
+        """
+        path = self.get_path(key)
+        is_cached = False
+
+        def mark_as_used(manifest: dict):
+            nonlocal is_cached
+            is_cached = key in manifest and path.exists()
+            if is_cached:
+                manifest[key]["last_used_at"] = time.time()
+
+        # Before loading, since the volume cannot be reloaded while the datasets
+        # keep their files open
+        self._update_manifest(mark_as_used)
+        if not is_cached:
+            return None, None
+
+        print(f"Loading train/eval cached datasets from {path}")
+        train_dataset = datasets.load_from_disk(path / "train")
+        eval_dataset = datasets.load_from_disk(path / "eval")
+
+        return train_dataset, eval_dataset
+
+    def save(
+        self,
+        key: str,
+        inputs: dict,
+        train_dataset: datasets.Dataset,
+        eval_dataset: datasets.Dataset,
+    ):
+        """
+        Saves the train and eval datasets under `key`, records them in the manifest
+        and evicts old entries if the cache is over its limits.
+        """
+        path = self.get_path(key)
+        if path.exists():
+            shutil.rmtree(path)
+
+        print(f"Caching processed datasets to {path}")
+        path.mkdir(parents=True, exist_ok=True)
+        train_dataset.save_to_disk(path / "train")
+        eval_dataset.save_to_disk(path / "eval")
+
+        now = time.time()
+        entry = {
+            "inputs": inputs,
+            "size_bytes": _get_size_bytes(path),
+            "created_at": now,
+            "last_used_at": now,
+        }
+
+        def add_entry(manifest: dict):
+            manifest[key] = entry
+
+        self._update_manifest(add_entry)
+
+        self.evict(keep=key)
+
+    def evict(self, keep: str | None = None):
+        """
+        Deletes the least recently used entries, except `keep`, until the cache has
+        at most `max_entries` entries and `max_size_gb` gigabytes.
+
+        Entry directories missing from the manifest count too, e.g. when another
+        run overwrote it before the manifest was merged on write. Their last
+        modification time stands for their last use.
+        """
+
+        def evict_entries(manifest: dict):
+            # Forget entries whose directory no longer exists
+            for key in [key for key in manifest if not self.get_path(key).exists()]:
+                del manifest[key]
+
+            for path in self._get_entry_paths():
+                if path.name not in manifest:
+                    modified_at = path.stat().st_mtime
+                    manifest[path.name] = {
+                        "inputs": None,
+                        "size_bytes": _get_size_bytes(path),
+                        "created_at": modified_at,
+                        "last_used_at": modified_at,
+                    }
+
+            def is_over_limits() -> bool:
+                if self.max_entries is not None and len(manifest) > self.max_entries:
+                    return True
+                size_bytes = sum(entry["size_bytes"] for entry in manifest.values())
+                if self.max_size_gb is not None and size_bytes > self.max_size_gb * 1e9:
+                    return True
+                return False
+
+            candidates = sorted(
+                (key for key in manifest if key != keep),
+                key=lambda key: manifest[key]["last_used_at"],
+            )
+            for key in candidates:
+                if not is_over_limits():
+                    break
+
+                print(f"Evicting cached datasets {key} ({manifest[key]['inputs']})")
+                shutil.rmtree(self.get_path(key), ignore_errors=True)
+                del manifest[key]
+
+        self._update_manifest(evict_entries)
+
+    def _get_entry_paths(self) -> list[Path]:
+        cache_path = self.root / "cache"
+        if not cache_path.exists():
+            return []
+        return [path for path in cache_path.iterdir() if path.is_dir()]
+
+    def _update_manifest(self, update: Callable[[dict], None]):
+        """
+        Applies `update` to the latest manifest and writes it, so the entries other
+        runs added or used since this one last read it are merged instead of
+        overwritten.
+
+        A Modal volume only shows the changes of other containers once they are
+        committed and this container reloads it, so the volume is reloaded right
+        before reading the manifest and committed right after writing it.
+        """
+        if self.volume is not None:
+            # Commits the changes of this container first (e.g. the datasets
+            # `save` just wrote), so reloading cannot lose them
+            self.volume.commit()
+            self.volume.reload()
+
+        manifest = self._read_manifest()
+        update(manifest)
+        self._write_manifest(manifest)
+
+        if self.volume is not None:
+            self.volume.commit()
+
+    def _read_manifest(self) -> dict:
+        manifest_path = self.root / "manifest.json"
+        if not manifest_path.exists():
+            return {}
+        return json.loads(manifest_path.read_text())
+
+    def _write_manifest(self, manifest: dict):
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Written aside and renamed, so concurrent readers never see a partial file
+        manifest_path = self.root / "manifest.json"
+        temporary_path = manifest_path.with_name(f"manifest.{time.time_ns()}.tmp")
+        temporary_path.write_text(json.dumps(manifest, indent=2))
+        temporary_path.replace(manifest_path)
+
+
+def _get_size_bytes(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
@@ -0,0 +1,78 @@
+"""
+Compact encoding of chess moves, used to store the instruction dataset on disk.
+
+A move is packed into a 16-bit integer:
+- bits 0-5: from square
+- bits 6-11: to square
+- bits 12-14: promotion piece type (0 if the move is not a promotion)
+
+The dataset stores, for each position, the packed valid moves and last 5 moves, and
+for each game the packed list of all its moves. The UCI columns the rest of the code
+expects (`valid_moves`, `last_5_moves_uci`, `moves_uci`) are derived at read time.
+"""
+
+from collections.abc import Iterable
+
+import chess
+
+
+def encode_move(move: chess.Move) -> int:
+    """
+    Packs a move into a 16-bit integer.
+    """
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+
+def decode_move(code: int) -> str:
+    """
+    Unpacks a 16-bit integer into a move in UCI notation.
+    """
+    move = chess.Move(
+        from_square=code & 0x3F,
+        to_square=(code >> 6) & 0x3F,
+        promotion=((code >> 12) & 0x7) or None,
+    )
+    return move.uci()
+
+
+def encode_moves(moves: Iterable[chess.Move]) -> list[int]:
+    return [encode_move(move) for move in moves]
+
+
+def decode_moves(codes: Iterable[int]) -> list[str]:
+    return [decode_move(code) for code in codes]
+
+
+def is_compact_dataset(column_names: list[str]) -> bool:
+    """
+    Checks if a dataset with the given columns uses the compact encoding.
+    """
+    return "valid_moves_packed" in column_names
+
+
+def decode_positions(batch: dict[str, list]) -> dict[str, list]:
+    """
+    Derives the `last_5_moves_uci` and `valid_moves` columns from the packed columns
+    of a batch of positions.
+
+    Meant to be used with `Dataset.map(decode_positions, batched=True)` or
+    `Dataset.with_transform(decode_positions)`.
+    """
+    decoded = {
+        name: values for name, values in batch.items() if not name.endswith("_packed")
+    }
+    decoded["last_5_moves_uci"] = [
+        decode_moves(codes) for codes in batch["last_5_moves_packed"]
+    ]
+    decoded["valid_moves"] = [
+        decode_moves(codes) for codes in batch["valid_moves_packed"]
+    ]
+    return decoded
+
+
+def get_moves_uci(game_moves_packed: list[int], move_number: int) -> list[str]:
+    """
+    Returns the moves in UCI notation played in a game before `move_number`, given
+    the packed moves of the game (the `moves_packed` column of the games table).
+    """
+    return decode_moves(game_moves_packed[:move_number])
@@ -0,0 +1,219 @@
+"""
+Playing-strength evaluation of the model while it trains.
+
+The eval loss says little about how well the model plays. At every evaluation step,
+`PlayingStrengthCallback` also measures, with the model in memory:
+- legal_move_rate: share of a fixed set of positions of the eval split where the
+  greedy answer of the model is a legal move
+- top1_agreement: share of those positions where it is the move actually played
+- win_rate, draw_rate: over a few games against a RandomPlayer, all played at once
+  with constrained decoding (see `fine_tune.constrained_decoding`), and drawn if
+  still going after `max_plies` moves
+
+The metrics are added to the evaluation metrics, so they can choose the best
+checkpoint (see `metric_for_best_checkpoint`), and logged to wandb, so runs that
+plateau can be stopped early instead of evaluating every checkpoint afterwards.
+"""
+
+import random
+import time
+
+import datasets
+import torch
+import wandb
+from transformers import TrainerCallback
+
+from .config import TrainingJobConfig
+from .data import split_dataset
+from .encoding import decode_positions, is_compact_dataset
+from .game import get_outcome, play_games
+from .players import LLMPlayer, RandomPlayer
+from .prompt_template import get_prompt
+
+
+def get_eval_positions(config: TrainingJobConfig, n_positions: int) -> list[dict]:
+    """
+    Returns the first `n_positions` positions of the eval split of
+    `prepare_datasets`, so the model is never evaluated on positions it trains on.
+    """
+    dataset = datasets.load_dataset(config.dataset_name, split="train")
+    if config.dataset_samples is not None:
+        dataset = dataset.select(range(config.dataset_samples))
+    eval_dataset = split_dataset(dataset, config)["test"]
+    positions = eval_dataset[: min(n_positions, len(eval_dataset))]
+    if is_compact_dataset(list(positions.keys())):
+        positions = decode_positions(positions)
+
+    return [
+        {
+            "game_state": game_state,
+            "last_5_moves_uci": last_5_moves_uci,
+            "valid_moves": valid_moves,
+            "next_move": next_move,
+        }
+        for game_state, last_5_moves_uci, valid_moves, next_move in zip(
+            positions["game_state"],
+            positions["last_5_moves_uci"],
+            positions["valid_moves"],
+            positions["next_move"],
+            strict=True,
+        )
+    ]
+
+
+class PlayingStrengthCallback(TrainerCallback):
+    def __init__(
+        self,
+        tokenizer: "AutoTokenizer",
+        positions: list[dict],
+        n_games: int = 8,
+        max_plies: int | None = 100,
+        prompt_format: str = "default",
+        batch_size: int = 64,
+        seed: int = 0,
+    ):
+        """
+        Args:
+            tokenizer: Tokenizer of the model being trained
+            positions: Positions to predict the next move of, see
+                `get_eval_positions`
+            n_games: Number of games against a RandomPlayer, half of them with white
+            max_plies: Games are drawn after this many moves, so each evaluation
+                costs at most `max_plies` batched `generate` calls
+            batch_size: Number of positions per `generate` call
+            seed: Seed of the sampling and of the RandomPlayer, the same at every
+                evaluation, so consecutive evaluations are comparable
+        """
+        self.tokenizer = tokenizer
+        self.positions = positions
+        self.n_games = n_games
+        self.max_plies = max_plies
+        self.prompt_format = prompt_format
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def on_evaluate(self, args, state, control, model=None, metrics=None, **kwargs):
+        if not state.is_world_process_zero:
+            return
+
+        start_time = time.perf_counter()
+        player = LLMPlayer(
+            model=model,
+            tokenizer=self.tokenizer,
+            decoding="constrained",
+            prefix_caching=False,
+            prompt_format=self.prompt_format,
+        )
+
+        # The evaluation must not change the random numbers training draws
+        python_rng_state = random.getstate()
+        was_training = model.training
+        model.eval()
+        try:
+            with torch.random.fork_rng():
+                random.seed(self.seed)
+                torch.manual_seed(self.seed)
+                playing_metrics = {
+                    **self._evaluate_positions(player),
+                    **self._evaluate_games(player),
+                }
+        finally:
+            random.setstate(python_rng_state)
+            if was_training:
+                model.train()
+
+        print(
+            f"Playing strength at step {state.global_step} "
+            f"({time.perf_counter() - start_time:.1f}s): "
+            + ", ".join(
+                f"{name}={value:.3f}" for name, value in playing_metrics.items()
+            )
+        )
+
+        if metrics is not None:
+            metrics.update({f"eval_{name}": v for name, v in playing_metrics.items()})
+        if wandb.run is not None:
+            wandb.log(
+                {
+                    **{f"eval/{name}": v for name, v in playing_metrics.items()},
+                    "train/global_step": state.global_step,
+                }
+            )
+
+    def _evaluate_positions(self, player: LLMPlayer) -> dict[str, float]:
+        """
+        Returns the legal move rate and top-1 agreement of the greedy answers of the
+        model on `positions`.
+        """
+        next_moves = []
+        for start in range(0, len(self.positions), self.batch_size):
+            texts = [
+                player.tokenizer.apply_chat_template(
+                    [
+                        {
+                            "role": "user",
+                            "content": get_prompt(
+                                game_state=position["game_state"],
+                                last_5_moves_uci=position["last_5_moves_uci"],
+                                valid_moves=position["valid_moves"],
+                                prompt_format=self.prompt_format,
+                            ),
+                        }
+                    ],
+                    add_generation_prompt=True,
+                    tokenize=False,
+                )
+                for position in self.positions[start : start + self.batch_size]
+            ]
+            inputs = player.tokenizer(
+                texts, return_tensors="pt", padding=True, add_special_tokens=False
+            ).to(player.model.device)
+
+            with torch.no_grad():
+                # A move in UCI notation is a handful of tokens
+                output = player.model.generate(
+                    **inputs,
+                    do_sample=False,
+                    max_new_tokens=8,
+                    pad_token_id=player.tokenizer.pad_token_id,
+                )
+            next_moves += [
+                next_move.strip()
+                for next_move in player.tokenizer.batch_decode(
+                    output[:, inputs["input_ids"].shape[1] :], skip_special_tokens=True
+                )
+            ]
+
+        n_positions = max(len(self.positions), 1)
+        return {
+            "legal_move_rate": sum(
+                next_move in position["valid_moves"]
+                for next_move, position in zip(next_moves, self.positions, strict=True)
+            )
+            / n_positions,
+            "top1_agreement": sum(
+                next_move == position["next_move"]
+                for next_move, position in zip(next_moves, self.positions, strict=True)
+            )
+            / n_positions,
+        }
+
+    def _evaluate_games(self, player: LLMPlayer) -> dict[str, float]:
+        """
+        Returns the win and draw rates of `player` against a RandomPlayer.
+        """
+        if self.n_games == 0:
+            return {}
+
+        results = play_games(
+            player=player,
+            opponent=RandomPlayer(),
+            n_games=self.n_games,
+            max_concurrent_games=self.n_games,
+            max_plies=self.max_plies,
+        )
+        outcomes = [get_outcome(result, player.name) for result in results]
+        return {
+            "win_rate": outcomes.count("win") / len(outcomes),
+            "draw_rate": outcomes.count("draw") / len(outcomes),
+        }
@@ -2,10 +2,15 @@
 Bunch of functions to test the output produced by our ChessInstruct model make any sense
 """
 
+import random
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import torch
+import wandb
+
 from .config import TrainingJobConfig
-from .game import ChessGame
+from .game import ChessGameStats, get_outcome, play_games
 from .infra import (
     # get_docker_image,
     get_docker_image_for_evaluation,
@@ -14,7 +19,10 @@ from .infra import (
     # get_secrets,
     get_volume,
 )
+from .move_cache import MoveCache
 from .players import LLMPlayer, Player, RandomPlayer
+from .prompt_template import load_prompt_format
+from .telemetry import MoveRecord, Telemetry
 
 config = TrainingJobConfig()
 
@@ -35,40 +43,366 @@ model_checkpoints_volume = get_volume(config.modal_volume_model_checkpoints)
 )
 def evaluate(
     model_checkpoint_path: str,
-):
-    """ """
+    n_games: int = 1,
+    max_concurrent_games: int = 32,
+    decoding: str = "sample",
+    use_move_cache: bool = False,
+    telemetry_enabled: bool = False,
+) -> list[dict]:
+    """
+    Plays `n_games` games between the model and a random player, alternating colors,
+    with up to `max_concurrent_games` games in flight so the model generates the
+    moves of all of them in batches.
+
+    `decoding` is passed to the LLMPlayer: with "constrained" or "score" the model
+    can only play legal moves, so no game is aborted.
+
+    With "score" decoding and `use_move_cache`, the move distributions of the
+    positions seen are cached next to the checkpoint and reused by later runs.
+
+    Returns:
+        The move records of the games if `telemetry_enabled`, see
+        `fine_tune.telemetry`, or an empty list
+    """
     model_checkpoint_path = Path("/model_checkpoints") / model_checkpoint_path
+    telemetry = Telemetry() if telemetry_enabled else None
+
+    move_cache = None
+    if use_move_cache:
+        move_cache = MoveCache(
+            path=model_checkpoint_path / "move_cache.json",
+            prompt_format=load_prompt_format(model_checkpoint_path),
+        )
 
     # Initialize the AI player
-    ai_player = LLMPlayer(model_checkpoint_path=model_checkpoint_path)
+    ai_player = LLMPlayer(
+        model_checkpoint_path=model_checkpoint_path,
+        decoding=decoding,
+        move_cache=move_cache,
+    )
     sanity_check(ai_player)
 
     # Initialize the random player
     random_player = RandomPlayer()
     sanity_check(random_player)
 
-    game = ChessGame(
-        white_player=random_player,
-        black_player=ai_player,
+    results = play_games(
+        player=ai_player,
+        opponent=random_player,
+        n_games=n_games,
+        max_concurrent_games=max_concurrent_games,
+        log_enabled=n_games == 1,
+        telemetry=telemetry,
+    )
+    for result in results:
+        print(result)
+    print_summary(results, ai_player.name)
+
+    if move_cache is not None:
+        print(f"Move cache hits: {move_cache.n_hits}, misses: {move_cache.n_misses}")
+        move_cache.save()
+        model_checkpoints_volume.commit()
+
+    if telemetry is None:
+        return []
+    return [record.model_dump() for record in telemetry.records]
+
+
+@modal_app.function(
+    image=docker_image,
+    gpu=config.modal_gpu_type,
+    volumes={
+        "/model_checkpoints": model_checkpoints_volume,
+    },
+    timeout=config.modal_timeout_hours * 60 * 60,
+    retries=get_retries(),
+    max_inputs=1,  # Ensure we get a fresh container on retry
+)
+def evaluate_shard(
+    model_checkpoint: str,
+    n_games: int,
+    max_concurrent_games: int,
+    decoding: str,
+    seed: int,
+    telemetry_enabled: bool = False,
+) -> dict[str, list[dict]]:
+    """
+    Plays one shard of a sharded evaluation in its own container, see
+    `play_evaluation_games`.
+    """
+    return play_evaluation_games(
+        model_checkpoint=model_checkpoint,
+        model_checkpoint_path=Path("/model_checkpoints") / model_checkpoint,
+        n_games=n_games,
+        max_concurrent_games=max_concurrent_games,
+        decoding=decoding,
+        seed=seed,
+        telemetry_enabled=telemetry_enabled,
     )
-    result = game.play()
-    print(result)
 
 
 @modal_app.local_entrypoint()
 def main(
     model_checkpoint: str,
+    n_games: int = 1,
+    max_concurrent_games: int = 32,
+    decoding: str = "sample",
+    use_move_cache: bool = False,
+    n_shards: int = 1,
+    backend: str = "modal",
+    local_model_checkpoints_dir: str = "",
+    telemetry_path: str = "",
+    telemetry_to_wandb: bool = False,
 ):
+    """
+    With `n_shards` > 1 the games are split into shards played in parallel, each
+    one in its own Modal container, or in its own local process with the "local"
+    `backend`, see `evaluate_in_parallel`. The "local" backend, even with a single
+    shard, loads the checkpoint from `local_model_checkpoints_dir`, or plays a
+    RandomPlayer instead if it is not given.
+
+    `use_move_cache` needs "score" decoding, and a single shard on Modal.
+
+    Per-move telemetry is collected if `telemetry_path` (a local .jsonl or .parquet
+    file) is given or `telemetry_to_wandb` is set.
+    """
+    if use_move_cache and decoding != "score":
+        raise ValueError(f"use_move_cache needs score decoding, not {decoding}")
+    if use_move_cache and (n_shards > 1 or backend == "local"):
+        raise ValueError(
+            "use_move_cache is only supported by the single-shard modal evaluation"
+        )
+
     print(f"Running evaluation on the model {model_checkpoint}")
+    telemetry_enabled = bool(telemetry_path) or telemetry_to_wandb
 
-    # Launch the training job on Modal infrastructure
-    evaluate.remote(
-        model_checkpoint_path=model_checkpoint,
-    )
+    if n_shards > 1 or backend == "local":
+        _, telemetry = evaluate_in_parallel(
+            model_checkpoint=model_checkpoint,
+            n_games=n_games,
+            n_shards=n_shards,
+            backend=backend,
+            max_concurrent_games=max_concurrent_games,
+            decoding=decoding,
+            local_model_checkpoints_dir=(
+                Path(local_model_checkpoints_dir)
+                if local_model_checkpoints_dir
+                else None
+            ),
+            telemetry_enabled=telemetry_enabled,
+        )
+    else:
+        # Launch the training job on Modal infrastructure
+        move_records = evaluate.remote(
+            model_checkpoint_path=model_checkpoint,
+            n_games=n_games,
+            max_concurrent_games=max_concurrent_games,
+            decoding=decoding,
+            use_move_cache=use_move_cache,
+            telemetry_enabled=telemetry_enabled,
+        )
+        telemetry = Telemetry()
+        for move_record in move_records:
+            telemetry.record(MoveRecord(**move_record))
+
+    if telemetry_enabled:
+        report_telemetry(
+            telemetry, model_checkpoint, telemetry_path, telemetry_to_wandb
+        )
 
     print("✅ Evaluation completed!")
 
 
+def play_evaluation_games(
+    model_checkpoint: str,
+    model_checkpoint_path: Path | None,
+    n_games: int,
+    max_concurrent_games: int,
+    decoding: str,
+    seed: int,
+    telemetry_enabled: bool = False,
+) -> dict[str, list[dict]]:
+    """
+    Plays `n_games` games between the model and a random player, alternating colors,
+    and returns their stats, and move records if `telemetry_enabled`, as dicts, so
+    they can be sent back from another process or container.
+
+    The model plays under the name `model_checkpoint`. If `model_checkpoint_path`
+    is None, a RandomPlayer stands in for the model, so the sharding can be tested
+    offline, without a GPU.
+    """
+    random.seed(seed)
+
+    if model_checkpoint_path is None:
+        player = RandomPlayer()
+    else:
+        torch.manual_seed(seed)
+        player = LLMPlayer(
+            model_checkpoint_path=model_checkpoint_path, decoding=decoding
+        )
+    player.name = model_checkpoint
+
+    telemetry = Telemetry() if telemetry_enabled else None
+    results = play_games(
+        player=player,
+        opponent=RandomPlayer(),
+        n_games=n_games,
+        max_concurrent_games=max_concurrent_games,
+        telemetry=telemetry,
+    )
+    return {
+        "results": [result.model_dump() for result in results],
+        "move_records": [
+            record.model_dump() for record in (telemetry.records if telemetry else [])
+        ],
+    }
+
+
+def evaluate_in_parallel(
+    model_checkpoint: str,
+    n_games: int,
+    n_shards: int,
+    backend: str = "modal",
+    max_concurrent_games: int = 32,
+    decoding: str = "sample",
+    seed: int = 0,
+    local_model_checkpoints_dir: Path | None = None,
+    telemetry_enabled: bool = False,
+) -> tuple[list[ChessGameStats], Telemetry]:
+    """
+    Splits the `n_games` evaluation games of `model_checkpoint` into `n_shards`
+    shards, plays them in parallel and prints a summary of all the results.
+
+    Returns the stats of all the games, and their move records (if
+    `telemetry_enabled`) renumbered so game ids are unique across shards.
+
+    Backends:
+    - "modal": one container per shard, with `evaluate_shard.starmap`
+    - "local": one process per shard on this machine. The checkpoint is loaded
+      from `local_model_checkpoints_dir`, or a RandomPlayer stands in for the
+      model if it is None.
+
+    Each shard gets its own seed, derived from `seed`, so the games of different
+    shards differ and the whole evaluation is reproducible.
+    """
+    if backend not in ("modal", "local"):
+        raise ValueError(f"Unknown backend: {backend}")
+
+    shard_sizes = get_shard_sizes(n_games, n_shards)
+    shard_seeds = [seed + i for i in range(len(shard_sizes))]
+    print(f"Playing {n_games} games in {len(shard_sizes)} shards on {backend}")
+    if not shard_sizes:
+        print_summary([], model_checkpoint)
+        return [], Telemetry()
+
+    if backend == "modal":
+        shards_results = evaluate_shard.starmap(
+            (
+                model_checkpoint,
+                shard_size,
+                max_concurrent_games,
+                decoding,
+                shard_seed,
+                telemetry_enabled,
+            )
+            for shard_size, shard_seed in zip(shard_sizes, shard_seeds, strict=True)
+        )
+    else:
+        model_checkpoint_path = None
+        if local_model_checkpoints_dir is not None:
+            model_checkpoint_path = local_model_checkpoints_dir / model_checkpoint
+
+        with ProcessPoolExecutor(max_workers=len(shard_sizes)) as executor:
+            futures = [
+                executor.submit(
+                    play_evaluation_games,
+                    model_checkpoint=model_checkpoint,
+                    model_checkpoint_path=model_checkpoint_path,
+                    n_games=shard_size,
+                    max_concurrent_games=max_concurrent_games,
+                    decoding=decoding,
+                    seed=shard_seed,
+                    telemetry_enabled=telemetry_enabled,
+                )
+                for shard_size, shard_seed in zip(shard_sizes, shard_seeds, strict=True)
+            ]
+            shards_results = [future.result() for future in futures]
+
+    results = []
+    telemetry = Telemetry()
+    for shard_results in shards_results:
+        first_game_id = len(results)
+        results += [ChessGameStats(**result) for result in shard_results["results"]]
+        for move_record in shard_results["move_records"]:
+            move_record = MoveRecord(**move_record)
+            move_record.game_id += first_game_id
+            telemetry.record(move_record)
+
+    print_summary(results, model_checkpoint)
+    return results, telemetry
+
+
+def get_shard_sizes(n_games: int, n_shards: int) -> list[int]:
+    """
+    Splits `n_games` into at most `n_shards` shards of an even number of games
+    (except maybe the last one), so the model plays each color equally often.
+    """
+    shard_size = -(-n_games // n_shards)
+    shard_size += shard_size % 2
+
+    shard_sizes = []
+    while n_games > 0:
+        shard_sizes.append(min(shard_size, n_games))
+        n_games -= shard_sizes[-1]
+    return shard_sizes
+
+
+def report_telemetry(
+    telemetry: Telemetry,
+    model_checkpoint: str,
+    telemetry_path: str = "",
+    to_wandb: bool = False,
+):
+    """
+    Prints a summary of the move records of an evaluation, and saves them to
+    `telemetry_path` (.jsonl or .parquet) and/or logs them to wandb.
+    """
+    telemetry.print_summary()
+
+    if telemetry_path:
+        path = Path(telemetry_path)
+        if path.suffix == ".parquet":
+            telemetry.save_parquet(path)
+        else:
+            telemetry.save_jsonl(path)
+
+    if to_wandb:
+        wandb.init(
+            project=config.wandb_project_name,
+            name=f"evaluation-{model_checkpoint}",
+            job_type="evaluation",
+        )
+        telemetry.log_to_wandb()
+        wandb.finish()
+
+
+def print_summary(results: list[ChessGameStats], player_name: str):
+    """
+    Prints the win, draw, loss and abort rates of `player_name` over `results`
+    """
+    if not results:
+        print(f"No games played by {player_name}")
+        return
+
+    counts = {"win": 0, "draw": 0, "loss": 0, "aborted": 0}
+    for result in results:
+        counts[get_outcome(result, player_name)] += 1
+
+    print(f"Results of {player_name} over {len(results)} games:")
+    for outcome, count in counts.items():
+        print(f"  {outcome}: {count} ({count / len(results):.1%})")
+
+
 def sanity_check(player: Player):
     """
     Prints on console the next_move from the player for a set of cases
@@ -1,13 +1,19 @@
+import asyncio
+import time
+
 import chess
 from pydantic import BaseModel
 
 from .players import Player
+from .telemetry import MoveRecord, Telemetry
 
 
 class ChessGameStats(BaseModel):
     result: str
     n_moves: int
     moves: list[str]
+    white_player: str = ""
+    black_player: str = ""
 
 
 class ChessGame:
@@ -16,14 +22,33 @@ class ChessGame:
         white_player: Player,
         black_player: Player,
         log_enabled: bool = True,
+        game_id: int = 0,
+        telemetry: Telemetry | None = None,
+        max_plies: int | None = None,
     ):
+        """
+        Args:
+            game_id: Identifies the game in the `telemetry` records
+            telemetry: If given, a `MoveRecord` is added to it every time a player
+                is asked for a move
+            max_plies: If given, the game is scored as a draw once this many moves
+                were played, to bound the length of games no one can win
+        """
         self.white_player = white_player
         self.black_player = black_player
         self.previous_moves = []
         self.white_plays: bool = True
         self.board = chess.Board()
 
+        # Number of moves requested to the current player in this turn
+        self.n_attempts = 0
+        # Set once the game is over or aborted
+        self.stats: ChessGameStats | None = None
+
         self.log_enabled = log_enabled
+        self.game_id = game_id
+        self.telemetry = telemetry
+        self.max_plies = max_plies
 
     def play(self) -> ChessGameStats:
         """
@@ -32,43 +57,113 @@ class ChessGame:
         self._log("Starting a new game of chess!")
 
         # loop until the game is over
-        while not self._is_game_over():
+        while not self.is_finished():
             # Get player whose turn to play is NOW
-            player = self._get_player()
+            player = self.get_player()
 
             # Ask the player for its next move, until we get a valid move
-            next_move = ""
-            n_attempts = 0
-            while not self._is_valid_move(next_move):
-                # Ask player for its next move
-                next_move = player.get_next_move(self.previous_moves)
-
-                n_attempts += 1
-                if (n_attempts > 2) and ("LLMPlayer" in player.name):
-                    print(
-                        f"Player {player.name} failed to provide a valid move after \
-                            {n_attempts} attempts. Last move was: {next_move}"
-                    )
-
-                    return ChessGameStats(
-                        result="aborted",
-                        n_moves=len(self.previous_moves),
-                        moves=self.previous_moves,
-                    )
-
-            self._log(f"Applying move {next_move}")
-
-            # Apply the move and update the game state
-            self._apply_move(next_move)
-
-        # The game is over
-        self._log("Game over!")
-        result = self._get_result()
+            start_time = time.perf_counter()
+            next_move = player.get_next_move(self.previous_moves)
+            self.step(next_move, wall_time_s=time.perf_counter() - start_time)
+
+        return self.stats
+
+    async def play_async(self) -> ChessGameStats:
+        """
+        Async version of `play`, so many games can be played on one event loop
+        while they wait for their players.
+        """
+        self._log("Starting a new game of chess!")
+
+        while not self.is_finished():
+            player = self.get_player()
+            start_time = time.perf_counter()
+            next_move = await player.get_next_move_async(self.previous_moves)
+            self.step(next_move, wall_time_s=time.perf_counter() - start_time)
+
+            # Players that answer inline never suspend the game, so give the other
+            # games a chance to run after every move
+            await asyncio.sleep(0)
+
+        return self.stats
+
+    def is_finished(self) -> bool:
+        return self.stats is not None
+
+    def get_player(self) -> Player:
+        """
+        Returns the player whose turn is now
+        """
+        return self._get_player()
+
+    def step(self, next_move: str, wall_time_s: float = 0.0):
+        """
+        Handles the `next_move` proposed by the player whose turn is now, who took
+        `wall_time_s` seconds to come up with it.
+
+        Valid moves are applied. After an invalid move the same player is asked
+        again, unless it was already asked `Player.max_attempts` times for this
+        move (twice for an LLMPlayer): then the game is aborted.
+
+        The limit is an attribute of the player, not of its name, which callers
+        may change to label the player (e.g. with its checkpoint).
+        """
+        player = self._get_player()
+
+        self.n_attempts += 1
+        self._record_move(player, next_move, wall_time_s)
+        if not self._is_valid_move(next_move):
+            if (
+                player.max_attempts is not None
+                and self.n_attempts >= player.max_attempts
+            ):
+                print(
+                    f"Player {player.name} failed to provide a valid move after \
+                        {self.n_attempts} attempts. Last move was: {next_move}"
+                )
+                self.stats = self._get_stats(result="aborted")
+            return
+
+        self._log(f"Applying move {next_move}")
+
+        # Apply the move and update the game state
+        self._apply_move(next_move)
+        self.n_attempts = 0
+
+        if self._is_game_over():
+            # The game is over
+            self._log("Game over!")
+            self.stats = self._get_stats(result=self._get_result())
+        elif self.max_plies is not None and len(self.previous_moves) >= self.max_plies:
+            self._log(f"Game drawn after {self.max_plies} plies")
+            self.stats = self._get_stats(result="1/2-1/2")
 
+    def _record_move(self, player: Player, next_move: str, wall_time_s: float):
+        # Always collected, so players do not keep the telemetry of the position
+        player_telemetry = player.pop_move_telemetry(self.previous_moves)
+        if self.telemetry is None:
+            return
+
+        self.telemetry.record(
+            MoveRecord(
+                game_id=self.game_id,
+                ply=len(self.previous_moves),
+                player=player.name,
+                attempt=self.n_attempts,
+                output=next_move,
+                is_valid=self._is_valid_move(next_move),
+                wall_time_s=wall_time_s,
+                **player_telemetry,
+            )
+        )
+
+    def _get_stats(self, result: str) -> ChessGameStats:
         return ChessGameStats(
             result=result,
             n_moves=len(self.previous_moves),
             moves=self.previous_moves,
+            white_player=self.white_player.name,
+            black_player=self.black_player.name,
         )
 
     def _get_result(self) -> bool:
@@ -121,3 +216,150 @@ class ChessGame:
     def _log(self, msg: str):
         if self.log_enabled:
             print(msg)
+
+
+def get_outcome(result: ChessGameStats, player_name: str) -> str:
+    """
+    Returns the outcome of the game for `player_name`: "win", "draw", "loss", or
+    "aborted" if a player could not come up with a valid move.
+    """
+    if result.result == "1/2-1/2":
+        return "draw"
+    if result.result not in ("1-0", "0-1"):
+        return "aborted"
+    if (result.result == "1-0") == (result.white_player == player_name):
+        return "win"
+    return "loss"
+
+
+def play_games(
+    player: Player,
+    opponent: Player,
+    n_games: int,
+    max_concurrent_games: int = 32,
+    alternate_colors: bool = True,
+    log_enabled: bool = False,
+    telemetry: Telemetry | None = None,
+    max_plies: int | None = None,
+) -> list[ChessGameStats]:
+    """
+    Plays `n_games` games between `player` and `opponent`, with up to
+    `max_concurrent_games` games in progress at the same time. Games still going
+    after `max_plies` moves, if given, are drawn.
+
+    At every step, the positions of all games waiting for the same player are
+    answered with a single `Player.get_next_moves` call, so an LLMPlayer runs one
+    batched `generate` for all of them. Finished games leave the batch and new
+    games take their place.
+
+    `player` plays white in even games, and black in odd games if
+    `alternate_colors` is True.
+
+    With `telemetry`, the wall time recorded for each move is the time of the
+    whole batched call the move was part of.
+
+    Returns:
+        The stats of each game, in the order the games were started
+    """
+    results: list[ChessGameStats | None] = [None] * n_games
+    active_games: dict[int, ChessGame] = {}
+    n_started_games = 0
+
+    while n_started_games < n_games or active_games:
+        # Fill the free slots with new games
+        while n_started_games < n_games and len(active_games) < max_concurrent_games:
+            if alternate_colors and n_started_games % 2 == 1:
+                white_player, black_player = opponent, player
+            else:
+                white_player, black_player = player, opponent
+            active_games[n_started_games] = ChessGame(
+                white_player,
+                black_player,
+                log_enabled=log_enabled,
+                game_id=n_started_games,
+                telemetry=telemetry,
+                max_plies=max_plies,
+            )
+            n_started_games += 1
+
+        # Group the games by the player whose turn it is
+        games_per_player: dict[int, list[int]] = {}
+        for game_index, game in active_games.items():
+            games_per_player.setdefault(id(game.get_player()), []).append(game_index)
+
+        for game_indices in games_per_player.values():
+            games = [active_games[game_index] for game_index in game_indices]
+            start_time = time.perf_counter()
+            next_moves = (
+                games[0]
+                .get_player()
+                .get_next_moves([game.previous_moves for game in games])
+            )
+            wall_time_s = time.perf_counter() - start_time
+            for game, next_move in zip(games, next_moves, strict=True):
+                game.step(next_move, wall_time_s=wall_time_s)
+
+        for game_index in [i for i, game in active_games.items() if game.is_finished()]:
+            results[game_index] = active_games.pop(game_index).stats
+
+    return results
+
+
+async def play_games_async(
+    pairings: list[tuple[Player, Player]],
+    max_concurrent_games: int = 1024,
+    log_enabled: bool = False,
+    telemetry: Telemetry | None = None,
+) -> list[ChessGameStats]:
+    """
+    Plays one game for each (white player, black player) pair in `pairings` on the
+    running event loop, with up to `max_concurrent_games` games at the same time.
+
+    Players answer through `Player.get_next_move_async`: CPU players inline, and
+    model-backed players through a shared inference queue that batches the
+    positions of all the games waiting for them. Any number of players can take
+    part, e.g. several checkpoints against each other.
+
+    Returns:
+        The stats of each game, in the order of `pairings`
+    """
+    semaphore = asyncio.Semaphore(max_concurrent_games)
+
+    async def play_game(
+        game_id: int, white_player: Player, black_player: Player
+    ) -> ChessGameStats:
+        async with semaphore:
+            game = ChessGame(
+                white_player,
+                black_player,
+                log_enabled=log_enabled,
+                game_id=game_id,
+                telemetry=telemetry,
+            )
+            return await game.play_async()
+
+    return await asyncio.gather(
+        *(
+            play_game(game_id, white_player, black_player)
+            for game_id, (white_player, black_player) in enumerate(pairings)
+        )
+    )
+
+
+def schedule_games(
+    pairings: list[tuple[Player, Player]],
+    max_concurrent_games: int = 1024,
+    log_enabled: bool = False,
+    telemetry: Telemetry | None = None,
+) -> list[ChessGameStats]:
+    """
+    Runs `play_games_async` on a new event loop and returns its results.
+    """
+    return asyncio.run(
+        play_games_async(
+            pairings,
+            max_concurrent_games=max_concurrent_games,
+            log_enabled=log_enabled,
+            telemetry=telemetry,
+        )
+    )
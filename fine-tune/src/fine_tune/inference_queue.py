@@ -0,0 +1,67 @@
+"""
+Queue that batches the move requests many concurrent games send to one player.
+
+Games running on the same event loop `await InferenceQueue.submit(...)`. A single
+worker task takes all the requests pending at that moment, answers them with one
+call to the batch function (e.g. `LLMPlayer.get_next_moves`) in a separate thread,
+so the event loop keeps running the other games, and resolves their futures. The
+requests that arrive while a batch is running form the next batch.
+"""
+
+import asyncio
+from collections.abc import Callable
+
+
+class InferenceQueue:
+    def __init__(
+        self,
+        get_next_moves: Callable[[list[list[str]]], list[str]],
+        max_batch_size: int = 64,
+    ):
+        """
+        Args:
+            get_next_moves: Function that returns the next move for a batch of games,
+                given the previous moves of each game
+            max_batch_size: Maximum number of requests answered by a single call
+        """
+        self.get_next_moves = get_next_moves
+        self.max_batch_size = max_batch_size
+        # Futures are bound to the event loop the queue is created in
+        self.loop = asyncio.get_running_loop()
+
+        self._requests: list[tuple[list[str], asyncio.Future]] = []
+        self._worker: asyncio.Task | None = None
+
+    async def submit(self, previous_moves: list[str]) -> str:
+        """
+        Returns the next move for the game with `previous_moves`, once the batch it
+        belongs to has been answered.
+        """
+        future = self.loop.create_future()
+        self._requests.append((list(previous_moves), future))
+
+        if self._worker is None or self._worker.done():
+            self._worker = self.loop.create_task(self._run())
+
+        return await future
+
+    async def _run(self):
+        # Let the other games that are ready to play submit their requests too
+        await asyncio.sleep(0)
+
+        while self._requests:
+            batch = self._requests[: self.max_batch_size]
+            del self._requests[: self.max_batch_size]
+
+            try:
+                next_moves = await asyncio.to_thread(
+                    self.get_next_moves,
+                    [previous_moves for previous_moves, _ in batch],
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), next_move in zip(batch, next_moves, strict=True):
+                future.set_result(next_move)
@@ -42,6 +42,9 @@ def get_docker_image() -> modal.Image:
             "wandb==0.21.0",
             "torch==2.7.0",
             "pydantic-settings==2.10.1",
+            # `prepare_datasets` decodes the packed moves of the dataset with
+            # `fine_tune.encoding`, which uses python-chess
+            "chess==1.11.2",
             # TODO: not sure if I need this or not
             # "causal-conv1d==1.5.0.post8"
         )
@@ -11,6 +11,7 @@ from .infra import (
     get_volume,
 )
 from .model import prepare_model
+from .prompt_template import save_prompt_format
 from .trainer import prepare_trainer
 
 config = TrainingJobConfig()
@@ -55,47 +56,76 @@ def finetune(config: TrainingJobConfig):
     print(f"Loading and processing train/eval datasets for {config.dataset_name}")
     train_dataset, eval_dataset = prepare_datasets(config, datasets_volume, tokenizer)
 
-    # Prepare checkpoint directory and check for existing checkpoints
-    # from .checkpoints import check_for_existing_checkpoint
-    # checkpoint_path = paths["checkpoints"]
-    # checkpoint_path.mkdir(parents=True, exist_ok=True)
-    # resume_from_checkpoint = check_for_existing_checkpoint(paths)
-    # resume_from_checkpoint = False
-
-    from .checkpoints import _get_or_create_path_to_model_checkpoints
+    # Prepare checkpoint directory and check for existing checkpoints. Retries of
+    # this function get the same config, so they find the checkpoints of the
+    # attempts before them.
+    from .checkpoints import (
+        AsyncCheckpointCallback,
+        VolumeCommitCallback,
+        _get_or_create_path_to_model_checkpoints,
+        check_for_existing_checkpoint,
+    )
 
     checkpoint_path = _get_or_create_path_to_model_checkpoints(
         config.wandb_experiment_name
     )
+    resume_from_checkpoint = check_for_existing_checkpoint(checkpoint_path)
+    # Players built from the checkpoints read it to prompt the model the same way
+    save_prompt_format(checkpoint_path, config.prompt_format)
 
     print("Preparing trainer...")
     trainer = prepare_trainer(
         model, tokenizer, train_dataset, eval_dataset, config, checkpoint_path
     )
+    if config.eval_sample_callback_enabled:
+        from .eval_callback import PlayingStrengthCallback, get_eval_positions
+
+        # Added first, so the checkpoint callbacks see its metrics
+        trainer.add_callback(
+            PlayingStrengthCallback(
+                tokenizer=tokenizer,
+                positions=get_eval_positions(config, config.eval_sample_positions),
+                n_games=config.eval_sample_games,
+                max_plies=config.eval_sample_max_plies,
+                prompt_format=config.prompt_format,
+                seed=config.seed,
+            )
+        )
+    trainer.add_callback(VolumeCommitCallback(model_checkpoints_volume))
+    if config.async_checkpointing:
+        trainer.add_callback(
+            AsyncCheckpointCallback(
+                checkpoint_dir=checkpoint_path,
+                volume=model_checkpoints_volume,
+                save_steps=config.save_steps,
+                keep_last=config.checkpoints_keep_last,
+                metric_for_best_checkpoint=config.metric_for_best_checkpoint,
+                greater_is_better=config.greater_is_better,
+            )
+        )
 
-    # # Start training or resume from checkpoint
-    # if resume_from_checkpoint:
-    #     print(f"Resuming training from {resume_from_checkpoint}")
-    #     trainer.train(resume_from_checkpoint=resume_from_checkpoint)
-    # else:
-    #     print("Starting training from scratch...")
-    #     trainer.train()
-
-    print("Start trainining...")
-    trainer.train()
+    # Start training or resume from checkpoint. Resuming restores the model,
+    # optimizer, scheduler and RNG states, and skips the batches already trained on
+    if resume_from_checkpoint:
+        print(f"Resuming training from {resume_from_checkpoint}")
+        trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+    else:
+        print("Starting training from scratch...")
+        trainer.train()
 
     # Save the final trained model and tokenizer
     print("Saving final model...")
     final_model_path = checkpoint_path / "final_model"
     model.save_pretrained(final_model_path)
     tokenizer.save_pretrained(final_model_path)
+    model_checkpoints_volume.commit()
 
     # Clean up experiment tracking
-    if config.enable_wandb:
+    if config.wandb_enabled:
         wandb.finish()
 
     print(f"Training completed! Model saved to: {final_model_path}")
-    return config.experiment_name
+    return config.wandb_experiment_name
 
 
 @modal_app.local_entrypoint()
@@ -110,6 +140,7 @@ def main(
     warmup_ratio: float = 0.05,
     experiment_name: str = None,
     invalidate_dataset_cache: bool = False,
+    prompt_format: str = "default",
 ):
     # print(f'Invalidate dataset cache: {invalidate_dataset_cache}')
 
@@ -125,11 +156,13 @@ def main(
         warmup_ratio=warmup_ratio,
         wandb_experiment_name=experiment_name,
         invalidate_dataset_cache=invalidate_dataset_cache,
+        prompt_format=prompt_format,
     )
 
     print(f"Starting finetuning experiment {config.wandb_experiment_name}...")
     print(f"Model: {config.model_name}")
     print(f"Dataset: {config.dataset_name}")
+    print(f"Prompt format: {config.prompt_format}")
     print(f"LoRA configuration: rank={config.lora_r}, alpha={config.lora_alpha}")
     print(
         f"Effective batch size: \
@@ -0,0 +1,95 @@
+"""
+LRU cache of the move distributions computed by an LLMPlayer, keyed by position.
+
+The prompt of a position only depends on its FEN and its last 5 moves (the valid
+moves are derived from the FEN), so the distribution of the legal moves the model
+computes for it, see `LLMPlayer.get_move_distribution`, can be reused every time
+the position appears again. Sampling params are not part of the key: the move is
+sampled from the cached distribution afterwards.
+
+The cache can be persisted to a JSON file, which records the version of the prompt
+template the distributions were computed with. A file written with another version
+of the template, or another prompt format, is ignored.
+"""
+
+import json
+from collections import OrderedDict
+from pathlib import Path
+
+from .prompt_template import get_prompt_template_version
+
+
+class MoveCache:
+    def __init__(
+        self,
+        max_size: int = 100_000,
+        path: Path | None = None,
+        prompt_format: str = "default",
+    ):
+        """
+        Args:
+            max_size: Maximum number of positions kept, the least recently used
+                ones are evicted first
+            path: JSON file the cache is loaded from, if it exists, and saved to
+            prompt_format: Prompt format of the player the distributions come from
+        """
+        self.max_size = max_size
+        self.path = path
+        self.prompt_format = prompt_format
+        self.prompt_template_version = get_prompt_template_version(prompt_format)
+        self._distributions: OrderedDict[str, dict[str, float]] = OrderedDict()
+
+        self.n_hits = 0
+        self.n_misses = 0
+
+        if path is not None and path.exists():
+            self.load()
+
+    @staticmethod
+    def get_key(game_state: str, last_5_moves_uci: list[str]) -> str:
+        return f"{game_state}|{' '.join(last_5_moves_uci)}"
+
+    def get(self, key: str) -> dict[str, float] | None:
+        """
+        Returns the move distribution cached for `key`, or None.
+        """
+        distribution = self._distributions.get(key)
+        if distribution is None:
+            self.n_misses += 1
+            return None
+
+        self.n_hits += 1
+        self._distributions.move_to_end(key)
+        return distribution
+
+    def put(self, key: str, distribution: dict[str, float]):
+        self._distributions[key] = distribution
+        self._distributions.move_to_end(key)
+        while len(self._distributions) > self.max_size:
+            self._distributions.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._distributions)
+
+    def load(self):
+        data = json.loads(self.path.read_text())
+        if data["prompt_template_version"] != self.prompt_template_version:
+            print(f"Ignoring move cache {self.path}, computed with another prompt")
+            return
+
+        # Entries are saved from least to most recently used
+        for key, distribution in data["distributions"].items():
+            self.put(key, distribution)
+        print(f"Loaded {len(self)} positions from move cache {self.path}")
+
+    def save(self):
+        if self.path is None:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = {
+            "prompt_template_version": self.prompt_template_version,
+            "distributions": self._distributions,
+        }
+        self.path.write_text(json.dumps(data))
+        print(f"Saved {len(self)} positions to move cache {self.path}")
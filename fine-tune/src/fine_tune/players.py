@@ -1,13 +1,27 @@
+import asyncio
+import copy
 import random
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Literal
 
 import chess
 import torch
 from peft import PeftConfig, PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import (
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    Cache,
+    LogitsProcessorList,
+)
 
-from .prompt_template import get_prompt
+from .constrained_decoding import LegalMovesLogitsProcessor, MoveTrie
+from .inference_queue import InferenceQueue
+from .move_cache import MoveCache
+from .prompt_template import get_prompt, load_prompt_format
 
 
 class Player(ABC):
@@ -15,6 +29,19 @@ class Player(ABC):
     Abstract base class for chess players.
     """
 
+    # Number of positions whose board is cached, see `_get_position`. It should be
+    # larger than the number of games the player plays at the same time
+    board_cache_size: int = 1024
+    # Maximum number of times the player is asked for the same move: its game is
+    # aborted after that many invalid moves, see `ChessGame.step`. None asks again
+    # until the move is valid
+    max_attempts: int | None = None
+
+    def __init__(self):
+        self._positions: OrderedDict[tuple[str, ...], _CachedPosition] = OrderedDict()
+        # Telemetry of the last moves, see `pop_move_telemetry`
+        self._move_telemetry: OrderedDict[tuple[str, ...], deque[dict]] = OrderedDict()
+
     @abstractmethod
     def get_next_move(self, previous_moves: list[str]) -> str:
         """
@@ -28,9 +55,69 @@ class Player(ABC):
         """
         pass
 
+    def get_next_moves(self, previous_moves_batch: list[list[str]]) -> list[str]:
+        """
+        Get the next move for several games at once.
+
+        Args:
+            previous_moves_batch: List of previous moves of each game
+
+        Returns:
+            The next move of each game. Players that can batch their work (e.g.
+            LLM inference) override this, the default asks one game at a time.
+        """
+        return [
+            self.get_next_move(previous_moves)
+            for previous_moves in previous_moves_batch
+        ]
+
+    async def get_next_move_async(self, previous_moves: list[str]) -> str:
+        """
+        Async version of `get_next_move`, for games played on an event loop.
+
+        The default answers inline, which suits players that only need a bit of
+        CPU. Players backed by a model override it to go through an
+        `InferenceQueue`.
+        """
+        return self.get_next_move(previous_moves)
+
+    def pop_move_telemetry(self, previous_moves: list[str]) -> dict:
+        """
+        Returns, and forgets, what the player recorded while computing its last
+        move for the position after `previous_moves`, as `MoveRecord` fields (see
+        `fine_tune.telemetry`). Empty for players that record nothing.
+
+        Telemetry is keyed by position rather than returned with the move, so it
+        also reaches the game when moves are computed in batches or through an
+        `InferenceQueue`. Concurrent games often ask for the same position (e.g.
+        the first move), so each position keeps one record per move computed, and
+        each call pops the oldest one.
+        """
+        key = tuple(previous_moves)
+        records = self._move_telemetry.get(key)
+        if not records:
+            return {}
+
+        fields = records.popleft()
+        if not records:
+            del self._move_telemetry[key]
+        return fields
+
+    def _set_move_telemetry(self, previous_moves: list[str], **fields):
+        key = tuple(previous_moves)
+        self._move_telemetry.setdefault(key, deque()).append(fields)
+        self._move_telemetry.move_to_end(key)
+        # Telemetry nobody collects (e.g. moves asked outside of a ChessGame) is
+        # dropped after a while
+        while len(self._move_telemetry) > self.board_cache_size:
+            self._move_telemetry.popitem(last=False)
+
     def _get_board(self, previous_moves: list[str]) -> chess.Board:
         """
-        Get the current game state in FEN notation based on previous UCI moves.
+        Get the current board based on previous UCI moves.
+
+        The returned board is shared with the position cache, so callers must not
+        mutate it.
 
         Args:
             previous_moves: List of moves in UCI notation (e.g., ['e2e4', 'e7e5'])
@@ -38,30 +125,100 @@ class Player(ABC):
         Returns:
             board
         """
-        board = chess.Board()
+        return self._get_position(previous_moves).board
 
-        for move_uci in previous_moves:
+    def _get_position(self, previous_moves: list[str]) -> "_CachedPosition":
+        """
+        Returns the cached position after `previous_moves`.
+
+        The last `board_cache_size` positions are cached, e.g. one per game when
+        several games are played at once. A new position is built by pushing only
+        the missing moves onto the board of an earlier position of the same game
+        (usually 2 plies back: our last move and the opponent's reply), so
+        consecutive calls during a game cost one ply instead of a replay of the
+        whole game.
+        """
+        key = tuple(previous_moves)
+        position = self._positions.get(key)
+        if position is not None:
+            self._positions.move_to_end(key)
+            return position
+
+        # Look for an earlier position of the same game, else start from scratch
+        for n_moves in range(len(key) - 1, max(len(key) - 5, -1), -1):
+            position = self._positions.pop(key[:n_moves], None)
+            if position is not None:
+                break
+        else:
+            position = _CachedPosition(board=chess.Board(), n_moves=0)
+
+        # Push only the new moves
+        for move_uci in previous_moves[position.n_moves :]:
             try:
                 move = chess.Move.from_uci(move_uci)
-                if move in board.legal_moves:
-                    board.push(move)
+                if position.board.is_legal(move):
+                    position.board.push(move)
                 else:
                     raise ValueError(f"Illegal move: {move_uci}")
             except (chess.InvalidMoveError, ValueError) as e:
                 raise ValueError(f"Invalid move in sequence: {move_uci}") from e
 
-        return board
+        position.n_moves = len(previous_moves)
+        position.fen = None
+        position.valid_moves = None
+
+        self._positions[key] = position
+        if len(self._positions) > self.board_cache_size:
+            self._positions.popitem(last=False)
+
+        return position
 
     def _get_game_state(self, previous_moves: list[str]) -> str:
-        board = self._get_board(previous_moves)
-        return board.fen()
+        position = self._get_position(previous_moves)
+        if position.fen is None:
+            position.fen = position.board.fen()
+        return position.fen
 
     def _get_last_5_moves(self, previous_moves: list[str]) -> list[str]:
         return previous_moves[-5:]
 
     def _get_valid_moves(self, previous_moves: list[str]) -> list[str]:
-        board = self._get_board(previous_moves)
-        return [str(move) for move in board.legal_moves]
+        position = self._get_position(previous_moves)
+        if position.valid_moves is None:
+            position.valid_moves = [str(move) for move in position.board.legal_moves]
+        # Return a copy so callers cannot corrupt the cached list
+        return list(position.valid_moves)
+
+
+def _prepare_tokenizer(tokenizer: AutoTokenizer) -> AutoTokenizer:
+    # Batched generation needs left padding
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def _reset_gpu_memory_peak():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def _get_gpu_memory_peak_mb() -> float | None:
+    """
+    Returns the peak GPU memory allocated since the last `_reset_gpu_memory_peak`,
+    shared by all the players running on the device.
+    """
+    if not torch.cuda.is_available():
+        return None
+    return torch.cuda.max_memory_allocated() / 2**20
+
+
+@dataclass
+class _CachedPosition:
+    board: chess.Board
+    n_moves: int
+    fen: str | None = None
+    valid_moves: list[str] | None = None
 
 
 class LLMPlayer(Player):
@@ -70,64 +227,466 @@ class LLMPlayer(Player):
     for this task.
     """
 
+    # Maximum number of positions answered together by `get_next_move_async`
+    max_batch_size: int = 64
+    # Sampled answers can be invalid forever
+    max_attempts: int | None = 2
+
     def __init__(
         self,
-        model_checkpoint_path: Path,
+        model_checkpoint_path: Path | None = None,
+        decoding: Literal["sample", "constrained", "score"] = "sample",
+        scoring_temperature: float = 0.0,
+        prefix_caching: bool = True,
+        move_cache: MoveCache | None = None,
+        prompt_format: str | None = None,
+        model: AutoModelForCausalLM | None = None,
+        tokenizer: AutoTokenizer | None = None,
     ):
-        print(f"🤖 Initializing LLMPlayer from {model_checkpoint_path}")
-
-        # Load the model and tokenizer
-        self.model, self.tokenizer = self._load_model_and_tokenizer(
-            model_checkpoint_path=model_checkpoint_path
-        )
-        print("🤖 LLMPlayer was successfully initialized!")
-
-        self.name = f"LLMPlayer-from-{model_checkpoint_path}"
+        """
+        Args:
+            model_checkpoint_path: Path to the LoRA adapter of the fine-tuned model
+            decoding: How the next move is chosen:
+                - "sample": free text generation, which can produce invalid moves
+                - "constrained": generation restricted to the legal moves, see
+                  `fine_tune.constrained_decoding`
+                - "score": every legal move is scored by its likelihood, see
+                  `get_move_distribution`
+            scoring_temperature: With "score" decoding, the temperature used to
+                sample the move from the distribution. 0 picks the most likely move.
+            prefix_caching: If True, the KV cache of the static beginning of the
+                prompt is computed once and reused for every move, see
+                `_get_prefix_cache`
+            move_cache: With "score" decoding, cache of the move distributions of
+                the positions already seen, so repeated positions skip the model
+            prompt_format: Prompt format of `fine_tune.prompt_template`. By default,
+                the one the model was trained with
+            model, tokenizer: Model already in memory, e.g. the one being trained,
+                used instead of loading `model_checkpoint_path`
+        """
+        if decoding not in ("sample", "constrained", "score"):
+            raise ValueError(f"Unknown decoding: {decoding}")
+        if (model_checkpoint_path is None) == (model is None):
+            raise ValueError("Pass either a model_checkpoint_path or a model")
+        if move_cache is not None and decoding != "score":
+            # Only scoring computes move distributions, the cache would stay empty
+            raise ValueError(f"move_cache needs score decoding, not {decoding}")
+
+        if prompt_format is None:
+            prompt_format = (
+                load_prompt_format(model_checkpoint_path)
+                if model_checkpoint_path is not None
+                else "default"
+            )
+        if move_cache is not None and move_cache.prompt_format != prompt_format:
+            raise ValueError(
+                f"The move cache was built with the {move_cache.prompt_format} prompt "
+                f"format, but the player uses {prompt_format}"
+            )
+
+        super().__init__()
+
+        if model is None:
+            print(f"🤖 Initializing LLMPlayer from {model_checkpoint_path}")
+
+            # Load the model and tokenizer
+            start_time = time.perf_counter()
+            self.model, self.tokenizer = self._load_model_and_tokenizer(
+                model_checkpoint_path=model_checkpoint_path
+            )
+            self.load_time_s = time.perf_counter() - start_time
+            print(
+                f"🤖 LLMPlayer was successfully initialized in {self.load_time_s:.1f}s!"
+            )
+            self.name = f"LLMPlayer-from-{model_checkpoint_path}"
+        else:
+            # The tokenizer is copied, so left padding does not leak to its owner
+            self.model = model
+            self.tokenizer = _prepare_tokenizer(copy.deepcopy(tokenizer))
+            self.load_time_s = 0.0
+            self.name = "LLMPlayer-in-memory"
+
+        self.decoding = decoding
+        self.scoring_temperature = scoring_temperature
+        self.move_cache = move_cache
+        self.prompt_format = prompt_format
+
+        # Token ids of each move seen so far, see `_get_moves_token_ids`
+        self._moves_token_ids: dict[str, list[int]] = {}
+
+        # Token ids and KV cache of the static beginning of the prompt
+        self._prefix_ids: list[int] | None = None
+        self._prefix_cache: Cache | None = None
+        self._inference_queue: InferenceQueue | None = None
+        if prefix_caching:
+            self._prefix_ids, self._prefix_cache = self._build_prefix_cache()
         # self.name = 'LLMPlayer'
 
     def get_next_move(self, previous_moves: list[str]) -> str:
         """
         Get the next move for the player based on previous moves.
         """
-        game_state = self._get_game_state(previous_moves)
-        last_5_moves_uci = self._get_last_5_moves(previous_moves)
+        return self.get_next_moves([previous_moves])[0]
+
+    async def get_next_move_async(self, previous_moves: list[str]) -> str:
+        """
+        Get the next move through the inference queue of this player, which batches
+        the positions of all the games waiting for it on the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._inference_queue is None or self._inference_queue.loop is not loop:
+            self._inference_queue = InferenceQueue(
+                self.get_next_moves, max_batch_size=self.max_batch_size
+            )
+        return await self._inference_queue.submit(previous_moves)
+
+    def get_next_moves(self, previous_moves_batch: list[list[str]]) -> list[str]:
+        """
+        Get the next move for several games at once.
+        """
+        if self.decoding == "score":
+            return [
+                self._sample_move(self.get_move_distribution(previous_moves))
+                for previous_moves in previous_moves_batch
+            ]
+        return self._generate_next_moves(previous_moves_batch)
+
+    def get_move_distribution(self, previous_moves: list[str]) -> dict[str, float]:
+        """
+        Returns the probability the model assigns to each legal move, from the
+        `move_cache` if the position was already scored.
+        """
+        if self.move_cache is None:
+            return self._score_moves(previous_moves)
+
+        key = MoveCache.get_key(
+            self._get_game_state(previous_moves),
+            self._get_last_5_moves(previous_moves),
+        )
+        move_distribution = self.move_cache.get(key)
+        if move_distribution is None:
+            move_distribution = self._score_moves(previous_moves)
+            self.move_cache.put(key, move_distribution)
+        else:
+            self._set_move_telemetry(
+                previous_moves, batch_size=1, prefill_tokens=0, decode_tokens=0
+            )
+        return move_distribution
+
+    def _score_moves(self, previous_moves: list[str]) -> dict[str, float]:
+        """
+        Returns the probability the model assigns to each legal move.
+
+        Each move is scored by the log-probability of its tokens, followed by the
+        end of the answer, given the prompt. The prompt goes through the model once,
+        and its KV cache is shared by all the moves, which are scored together in a
+        handful of batched steps (one per token of the longest move).
+        """
         valid_moves = self._get_valid_moves(previous_moves)
+        device = self.model.device
+
+        prompt_ids = self.tokenizer(
+            self._get_chat_text(previous_moves),
+            return_tensors="pt",
+            add_special_tokens=False,
+        )["input_ids"].to(device)
+
+        # One row per move with its tokens and the end of the answer, padded on the
+        # right. The scores of the padding tokens are masked out.
+        eos_token_id = self._get_eos_token_ids()[0]
+        moves_token_ids = self._get_moves_token_ids(valid_moves)
+        candidates = [moves_token_ids[move] + [eos_token_id] for move in valid_moves]
+        n_candidates = len(candidates)
+        max_length = max(len(token_ids) for token_ids in candidates)
+        candidate_ids = torch.full(
+            (n_candidates, max_length), self.tokenizer.pad_token_id, device=device
+        )
+        candidate_mask = torch.zeros_like(candidate_ids)
+        for row, token_ids in enumerate(candidates):
+            candidate_ids[row, : len(token_ids)] = torch.tensor(token_ids)
+            candidate_mask[row, : len(token_ids)] = 1
+
+        _reset_gpu_memory_peak()
+        with torch.no_grad():
+            # Prefill only the part of the prompt after the cached prefix, if any
+            prefix_cache = self._get_prefix_cache(prompt_ids)
+            cached_prefix_tokens = 0
+            if prefix_cache is not None:
+                cached_prefix_tokens = len(self._prefix_ids)
+                prompt_ids = prompt_ids[:, cached_prefix_tokens:]
+            output = self.model(
+                input_ids=prompt_ids,
+                past_key_values=prefix_cache,
+                use_cache=True,
+                logits_to_keep=1,
+            )
+            # Logits predicting each token of the candidates
+            logits = [output.logits[:, -1].expand(n_candidates, -1)]
+
+            # Copy the KV cache of the prompt for every candidate, and feed all the
+            # candidates one token at a time, like `generate` does, since hybrid
+            # models like LFM2 only support single token steps on a filled cache
+            past_key_values = output.past_key_values
+            past_key_values.reorder_cache(
+                torch.zeros(n_candidates, dtype=torch.long, device=device)
+            )
+            for position in range(max_length - 1):
+                output = self.model(
+                    input_ids=candidate_ids[:, position : position + 1],
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                past_key_values = output.past_key_values
+                logits.append(output.logits[:, -1])
+
+        log_probs = torch.log_softmax(torch.stack(logits, dim=1).float(), dim=-1)
+        token_log_probs = log_probs.gather(-1, candidate_ids.unsqueeze(-1)).squeeze(-1)
+        token_log_probs = torch.where(candidate_mask.bool(), token_log_probs, 0.0)
+        move_log_probs = token_log_probs.sum(dim=1)
+
+        self._set_move_telemetry(
+            previous_moves,
+            batch_size=1,
+            prefill_tokens=prompt_ids.shape[1],
+            cached_prefix_tokens=cached_prefix_tokens,
+            # Tokens of all the candidates fed after the prompt
+            decode_tokens=n_candidates * (max_length - 1),
+            gpu_memory_mb=_get_gpu_memory_peak_mb(),
+        )
+
+        probs = torch.softmax(move_log_probs, dim=0).tolist()
+        return dict(zip(valid_moves, probs, strict=True))
+
+    def _sample_move(self, move_distribution: dict[str, float]) -> str:
+        """
+        Picks a move from `move_distribution` with `scoring_temperature`.
+        """
+        if self.scoring_temperature == 0:
+            return max(move_distribution, key=move_distribution.get)
 
+        moves = list(move_distribution)
+        log_probs = torch.log(torch.tensor(list(move_distribution.values())))
+        probs = torch.softmax(log_probs / self.scoring_temperature, dim=0)
+        return moves[torch.multinomial(probs, num_samples=1).item()]
+
+    def _generate_next_moves(self, previous_moves_batch: list[list[str]]) -> list[str]:
+        """
+        Generates the next move for several games with a single batched `generate`
+        call.
+        """
+        texts = []
+        tries = []
+        for previous_moves in previous_moves_batch:
+            texts.append(self._get_chat_text(previous_moves))
+            if self.decoding == "constrained":
+                valid_moves = self._get_valid_moves(previous_moves)
+                tries.append(MoveTrie(self._get_moves_token_ids(valid_moves)))
+
+        # The chat template already adds the special tokens. Prompts are padded on
+        # the left, so the generated tokens of all prompts start at the same index.
+        inputs = self.tokenizer(
+            texts,
+            return_tensors="pt",
+            padding=True,
+            add_special_tokens=False,
+        ).to(self.model.device)
+
+        generation_kwargs = {}
+        cached_prefix_tokens = 0
+        # The prefix cache is only used for a single prompt: in a batch, the left
+        # padding of each prompt would have to go between the prefix and the rest of
+        # the prompt, which changes the state of convolutional layers like LFM2's
+        if len(texts) == 1:
+            prefix_cache = self._get_prefix_cache(inputs["input_ids"])
+            if prefix_cache is not None:
+                # `generate` only prefills the tokens that are not in the cache
+                generation_kwargs["past_key_values"] = prefix_cache
+                cached_prefix_tokens = len(self._prefix_ids)
+
+        if self.decoding == "constrained":
+            eos_token_ids = self._get_eos_token_ids()
+            generation_kwargs["logits_processor"] = LogitsProcessorList(
+                [
+                    LegalMovesLogitsProcessor(
+                        tries=tries,
+                        prompt_length=inputs["input_ids"].shape[1],
+                        eos_token_ids=eos_token_ids,
+                    )
+                ]
+            )
+            # A legal move is a handful of tokens, followed by the end of sequence
+            generation_kwargs["max_new_tokens"] = max(trie.depth for trie in tries) + 1
+            generation_kwargs["eos_token_id"] = eos_token_ids
+        else:
+            generation_kwargs["max_new_tokens"] = 512
+
+        _reset_gpu_memory_peak()
+        with torch.no_grad():
+            output = self.model.generate(
+                **inputs,
+                do_sample=True,
+                temperature=0.80,
+                min_p=0.15,
+                repetition_penalty=1.05,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **generation_kwargs,
+            )
+
+        # Decode only the new tokens, excluding the ones from input_ids
+        input_length = inputs["input_ids"].shape[1]
+        next_moves = self.tokenizer.batch_decode(
+            output[:, input_length:], skip_special_tokens=True
+        )
+        if self.decoding == "constrained":
+            next_moves = [next_move.strip() for next_move in next_moves]
+
+        gpu_memory_mb = _get_gpu_memory_peak_mb()
+        prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        decode_tokens = (
+            (output[:, input_length:] != self.tokenizer.pad_token_id)
+            .sum(dim=1)
+            .tolist()
+        )
+        for previous_moves, n_prompt_tokens, n_decode_tokens in zip(
+            previous_moves_batch, prompt_tokens, decode_tokens, strict=True
+        ):
+            self._set_move_telemetry(
+                previous_moves,
+                batch_size=len(previous_moves_batch),
+                prefill_tokens=n_prompt_tokens - cached_prefix_tokens,
+                cached_prefix_tokens=cached_prefix_tokens,
+                decode_tokens=n_decode_tokens,
+                gpu_memory_mb=gpu_memory_mb,
+            )
+
+        return next_moves
+
+    def _get_chat_text(self, previous_moves: list[str]) -> str:
+        """
+        Returns the prompt for the position after `previous_moves`, formatted with
+        the chat template and followed by the generation prompt.
+        """
         prompt = get_prompt(
-            game_state=game_state,
-            last_5_moves_uci=last_5_moves_uci,
-            valid_moves=valid_moves,
+            game_state=self._get_game_state(previous_moves),
+            last_5_moves_uci=self._get_last_5_moves(previous_moves),
+            valid_moves=self._get_valid_moves(previous_moves),
+            prompt_format=self.prompt_format,
         )
+        return self._apply_chat_template(prompt)
+
+    def _apply_chat_template(self, prompt: str) -> str:
         message = [{"role": "user", "content": prompt}]
 
-        input_ids = self.tokenizer.apply_chat_template(
+        return self.tokenizer.apply_chat_template(
             message,
             add_generation_prompt=True,
-            return_tensors="pt",
-            tokenize=True,
-        ).to(self.model.device)
-
-        # print('type(self.model)', type(self.model))
-        # print('type(self.tokenizer)', type(self.tokenizer))
-
-        output = self.model.generate(
-            input_ids,
-            do_sample=True,
-            temperature=0.80,
-            min_p=0.15,
-            repetition_penalty=1.05,
-            max_new_tokens=512,
-            # eos_token_id=None,
+            tokenize=False,
         )
 
-        # Decode only the new tokens, excluding the ones from input_ids
-        input_length = input_ids.shape[1]
-        output = self.tokenizer.decode(
-            output[0][input_length:], skip_special_tokens=True
+    def _build_prefix_cache(self) -> tuple[list[int] | None, Cache | None]:
+        """
+        Returns the token ids of the static beginning of the prompt (chat template
+        header and instructions, up to the game state) and their KV cache.
+
+        The cache is checked once against a full prefill of a prompt. If the model
+        does not give the same result when the rest of the prompt is prefilled on
+        top of the cache, prefix caching is disabled and (None, None) is returned.
+        """
+        # The prefix ends at the line break before the first variable field, so
+        # it is tokenized the same way on its own and inside a full prompt
+        game_state_placeholder = "{{ game_state }}"
+        text = self._apply_chat_template(
+            get_prompt(
+                game_state=game_state_placeholder,
+                last_5_moves_uci=[],
+                valid_moves=[],
+                prompt_format=self.prompt_format,
+            )
         )
-        # output = self.tokenizer.decode(output[0], skip_special_tokens=False)
+        prefix_end = text.rindex("\n", 0, text.index(game_state_placeholder)) + 1
+        prefix_ids = self.tokenizer(text[:prefix_end], add_special_tokens=False)[
+            "input_ids"
+        ]
+
+        device = self.model.device
+        input_ids = self.tokenizer(
+            self._get_chat_text([]), return_tensors="pt", add_special_tokens=False
+        )["input_ids"].to(device)
+        if input_ids[0, : len(prefix_ids)].tolist() != prefix_ids:
+            print("⚠️  The prompt prefix is not tokenized consistently, not caching it")
+            return None, None
+
+        try:
+            with torch.no_grad():
+                prefix_cache = self.model(
+                    input_ids=input_ids[:, : len(prefix_ids)], use_cache=True
+                ).past_key_values
+                expected_logits = self.model(
+                    input_ids=input_ids, logits_to_keep=1
+                ).logits[:, -1]
+                logits = self.model(
+                    input_ids=input_ids[:, len(prefix_ids) :],
+                    past_key_values=copy.deepcopy(prefix_cache),
+                    use_cache=True,
+                    logits_to_keep=1,
+                ).logits[:, -1]
+            is_consistent = torch.allclose(
+                torch.log_softmax(logits.float(), dim=-1),
+                torch.log_softmax(expected_logits.float(), dim=-1),
+                atol=0.05,
+            )
+        except (RuntimeError, ValueError, IndexError) as e:
+            print(f"⚠️  Prefilling on top of a KV cache failed: {e}")
+            is_consistent = False
+
+        if not is_consistent:
+            print("⚠️  Prompt prefix caching is not supported by this model")
+            return None, None
+
+        print(f"🧠 Cached the KV cache of the first {len(prefix_ids)} prompt tokens")
+        return prefix_ids, prefix_cache
+
+    def _get_prefix_cache(self, input_ids: torch.Tensor) -> Cache | None:
+        """
+        Returns a copy of the prefix KV cache, to prefill the single prompt
+        `input_ids` on top of it, or None if there is no prefix cache or the prompt
+        does not start with the prefix.
+        """
+        if self._prefix_cache is None:
+            return None
+        if input_ids[0, : len(self._prefix_ids)].tolist() != self._prefix_ids:
+            return None
+        # The model extends the cache in place, so every prompt gets its own copy
+        return copy.deepcopy(self._prefix_cache)
+
+    def _get_moves_token_ids(self, moves: list[str]) -> dict[str, list[int]]:
+        """
+        Returns the token ids of each of the `moves`.
 
-        return output
+        There are fewer than 2,000 distinct moves in UCI notation, so the token ids
+        of each move are computed once and cached.
+        """
+        new_moves = [move for move in moves if move not in self._moves_token_ids]
+        if new_moves:
+            # Moves are tokenized on their own, the way the assistant answer follows
+            # the generation prompt of the chat template
+            new_moves_token_ids = self.tokenizer(new_moves, add_special_tokens=False)
+            self._moves_token_ids.update(
+                zip(new_moves, new_moves_token_ids["input_ids"], strict=True)
+            )
+
+        return {move: self._moves_token_ids[move] for move in moves}
+
+    def _get_eos_token_ids(self) -> list[int]:
+        """
+        Returns the tokens that end the assistant answer.
+        """
+        eos_token_id = self.model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        if isinstance(eos_token_id, int):
+            return [eos_token_id]
+        return list(eos_token_id)
 
     @staticmethod
     def _load_model_and_tokenizer(
@@ -152,8 +711,8 @@ class LLMPlayer(Player):
 
         # Step 3: Load the tokenizer
         print("🔤 Loading tokenizer...")
-        tokenizer = AutoTokenizer.from_pretrained(
-            base_model_name, trust_remote_code=True
+        tokenizer = _prepare_tokenizer(
+            AutoTokenizer.from_pretrained(base_model_name, trust_remote_code=True)
         )
 
         # Step 4: Load and merge the LoRA adapter
@@ -168,6 +727,7 @@ class LLMPlayer(Player):
 
 class RandomPlayer(Player):
     def __init__(self):
+        super().__init__()
         self.name = "RandomPlayer"
 
     def get_next_move(self, previous_moves: list[str]) -> str:
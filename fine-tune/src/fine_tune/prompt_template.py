@@ -1,3 +1,7 @@
+import hashlib
+import json
+from pathlib import Path
+
 from jinja2 import Template
 
 # Define template as a string
@@ -13,18 +17,158 @@ Your next move should be in UCI format (e.g., 'e2e4', 'f8c8').
 Make sure your next move is one of the valid moves.
 """
 
+# Same information with a fraction of the tokens: moves separated by spaces instead
+# of a Python list repr, a one-line instruction, and the FEN without the move
+# counters (see `_compact_fen`)
+COMPACT_CHESS_PROMPT_TEMPLATE = """Best move in UCI.
+FEN: {{ game_state }}
+Last moves: {{ last_5_moves_uci | join(" ") }}
+Valid moves: {{ valid_moves | join(" ") }}
+"""
+
+# The model has to learn which moves are legal on its own
+COMPACT_NO_VALID_MOVES_CHESS_PROMPT_TEMPLATE = """Best move in UCI.
+FEN: {{ game_state }}
+Last moves: {{ last_5_moves_uci | join(" ") }}
+"""
+
+# Prompt formats a model can be trained and played with. The format a model was
+# trained with is saved next to its checkpoints, see `save_prompt_format`.
+PROMPT_FORMATS = {
+    "default": CHESS_PROMPT_TEMPLATE,
+    "compact": COMPACT_CHESS_PROMPT_TEMPLATE,
+    "compact-no-valid-moves": COMPACT_NO_VALID_MOVES_CHESS_PROMPT_TEMPLATE,
+}
+
+# Bump it when the code that fills the templates changes
+_PROMPT_RENDERING_VERSION = 1
+
+# Parsing and compiling the templates is much slower than rendering them, so we do
+# it once, when the module is imported.
+_chess_prompt_templates = {
+    prompt_format: Template(template)
+    for prompt_format, template in PROMPT_FORMATS.items()
+}
+
+
+def get_prompt_template_version(prompt_format: str = "default") -> str:
+    """
+    Returns a short hash that changes whenever the prompts of `prompt_format`
+    change, so caches of rendered or tokenized prompts can be keyed on it.
+    """
+    check_prompt_format(prompt_format)
+    if prompt_format == "default":
+        # Same version as before there were several formats, so existing caches
+        # stay valid
+        fingerprint = CHESS_PROMPT_TEMPLATE
+    else:
+        fingerprint = json.dumps(
+            [prompt_format, PROMPT_FORMATS[prompt_format], _PROMPT_RENDERING_VERSION]
+        )
+    return hashlib.sha256(fingerprint.encode()).hexdigest()[:12]
+
 
 def get_prompt(
     # player_to_move: str,
     game_state: str,
     last_5_moves_uci: list[str],
     valid_moves: list[str],
+    prompt_format: str = "default",
 ) -> str:
-    template = Template(CHESS_PROMPT_TEMPLATE)
-    prompt = template.render(
+    check_prompt_format(prompt_format)
+    if prompt_format != "default":
+        game_state = _compact_fen(game_state)
+
+    prompt = _chess_prompt_templates[prompt_format].render(
         # player_to_move=player_to_move,
         game_state=game_state,
         last_5_moves_uci=last_5_moves_uci,
         valid_moves=valid_moves,
     )
     return prompt
+
+
+def get_prompts(
+    game_states: list[str],
+    last_5_moves_uci: list[list[str]],
+    valid_moves: list[list[str]],
+    prompt_format: str = "default",
+) -> list[str]:
+    """
+    Batched version of `get_prompt`, with one list entry per position.
+
+    The arguments match the columns of a batch of the dataset, so it can be used
+    inside `datasets.map(batched=True)`.
+    """
+    return [
+        get_prompt(
+            game_state=game_state,
+            last_5_moves_uci=position_last_5_moves_uci,
+            valid_moves=position_valid_moves,
+            prompt_format=prompt_format,
+        )
+        for game_state, position_last_5_moves_uci, position_valid_moves in zip(
+            game_states, last_5_moves_uci, valid_moves, strict=True
+        )
+    ]
+
+
+def save_prompt_format(model_checkpoints_path: Path, prompt_format: str):
+    """
+    Records the prompt format of the model trained in `model_checkpoints_path`, so
+    the players built from its checkpoints prompt it the same way.
+    """
+    check_prompt_format(prompt_format)
+    model_checkpoints_path.mkdir(parents=True, exist_ok=True)
+    (model_checkpoints_path / "prompt_format.json").write_text(
+        json.dumps(
+            {
+                "prompt_format": prompt_format,
+                "prompt_template_version": get_prompt_template_version(prompt_format),
+            }
+        )
+    )
+
+
+def load_prompt_format(model_checkpoint_path: Path) -> str:
+    """
+    Returns the prompt format saved by `save_prompt_format` in the checkpoint
+    directory or in the training run directory that contains it. Models trained
+    before there were several formats use "default".
+    """
+    for path in (model_checkpoint_path, model_checkpoint_path.parent):
+        prompt_format_path = path / "prompt_format.json"
+        if not prompt_format_path.exists():
+            continue
+
+        data = json.loads(prompt_format_path.read_text())
+        prompt_format = data["prompt_format"]
+        if data["prompt_template_version"] != get_prompt_template_version(
+            prompt_format
+        ):
+            print(
+                f"⚠️  {model_checkpoint_path} was trained with another version of the "
+                f"{prompt_format} prompt format"
+            )
+        return prompt_format
+
+    return "default"
+
+
+def check_prompt_format(prompt_format: str):
+    """
+    Raises an error if `prompt_format` is not one of `PROMPT_FORMATS`.
+    """
+    if prompt_format not in PROMPT_FORMATS:
+        raise ValueError(
+            f"Unknown prompt format: {prompt_format}, "
+            f"use one of {', '.join(PROMPT_FORMATS)}"
+        )
+
+
+def _compact_fen(fen: str) -> str:
+    """
+    Drops the halfmove clock and fullmove number of the FEN, which do not change
+    which moves are legal.
+    """
+    return " ".join(fen.split(" ")[:4])
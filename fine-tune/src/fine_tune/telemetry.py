@@ -0,0 +1,153 @@
+"""
+Per-move telemetry of chess games.
+
+A `ChessGame` created with a `Telemetry` object records one `MoveRecord` every time
+it asks a player for a move: how long the player took, the raw output it returned,
+if it was a valid move and which attempt it was. Players that run a model add what
+happened inside the call, see `LLMPlayer.pop_move_telemetry`: size of the batch the
+position was part of, prompt tokens prefilled (and read from the prefix cache),
+tokens decoded and peak GPU memory.
+
+Records can be written to JSONL or Parquet files and logged to Weights & Biases.
+"""
+
+import json
+import statistics
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import wandb
+from pydantic import BaseModel
+
+
+class MoveRecord(BaseModel):
+    game_id: int
+    # Number of moves played in the game before this one
+    ply: int
+    player: str
+    # 1 for the first time the player is asked for this move, 2 for the first retry
+    attempt: int
+    output: str
+    is_valid: bool
+    wall_time_s: float
+    # Filled by players that run a model
+    batch_size: int | None = None
+    prefill_tokens: int | None = None
+    cached_prefix_tokens: int | None = None
+    decode_tokens: int | None = None
+    gpu_memory_mb: float | None = None
+
+
+# Explicit, so files of runs without model players have the same column types
+MOVE_RECORD_SCHEMA = pa.schema(
+    [
+        ("game_id", pa.int64()),
+        ("ply", pa.int32()),
+        ("player", pa.string()),
+        ("attempt", pa.int32()),
+        ("output", pa.string()),
+        ("is_valid", pa.bool_()),
+        ("wall_time_s", pa.float64()),
+        ("batch_size", pa.int32()),
+        ("prefill_tokens", pa.int32()),
+        ("cached_prefix_tokens", pa.int32()),
+        ("decode_tokens", pa.int32()),
+        ("gpu_memory_mb", pa.float64()),
+    ]
+)
+
+
+class Telemetry:
+    # Raw outputs are truncated to this number of characters
+    max_output_length: int = 200
+
+    def __init__(self):
+        self.records: list[MoveRecord] = []
+
+    def record(self, record: MoveRecord):
+        if len(record.output) > self.max_output_length:
+            record.output = record.output[: self.max_output_length]
+        self.records.append(record)
+
+    def save_jsonl(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            for record in self.records:
+                f.write(json.dumps(record.model_dump()) + "\n")
+        print(f"Saved {len(self.records)} move records to {path}")
+
+    def save_parquet(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pylist(
+            [record.model_dump() for record in self.records], schema=MOVE_RECORD_SCHEMA
+        )
+        pq.write_table(table, path)
+        print(f"Saved {len(self.records)} move records to {path}")
+
+    def get_summary(self) -> dict[str, float]:
+        """
+        Returns metrics aggregated over all the records.
+        """
+        if not self.records:
+            return {}
+
+        wall_times = sorted(record.wall_time_s for record in self.records)
+        summary = {
+            "n_calls": len(self.records),
+            "n_invalid_outputs": sum(not r.is_valid for r in self.records),
+            "n_retries": sum(r.attempt > 1 for r in self.records),
+            "wall_time_s_total": sum(wall_times),
+            "wall_time_s_p50": _get_percentile(wall_times, 0.5),
+            "wall_time_s_p95": _get_percentile(wall_times, 0.95),
+            "wall_time_s_max": wall_times[-1],
+        }
+
+        for field in ("prefill_tokens", "decode_tokens", "batch_size"):
+            values = [
+                getattr(record, field)
+                for record in self.records
+                if getattr(record, field) is not None
+            ]
+            if values:
+                summary[f"{field}_mean"] = statistics.mean(values)
+
+        gpu_memory = [
+            r.gpu_memory_mb for r in self.records if r.gpu_memory_mb is not None
+        ]
+        if gpu_memory:
+            summary["gpu_memory_mb_max"] = max(gpu_memory)
+
+        return summary
+
+    def print_summary(self):
+        print("Move telemetry:")
+        for name, value in self.get_summary().items():
+            if isinstance(value, float):
+                value = round(value, 3)
+            print(f"  {name}: {value}")
+
+    def log_to_wandb(self):
+        """
+        Logs the summary and a table with all the records to the current wandb run.
+        """
+        if wandb.run is None:
+            print("No active wandb run, skipping move telemetry logging")
+            return
+
+        wandb.log(
+            {f"telemetry/{name}": value for name, value in self.get_summary().items()}
+        )
+        columns = list(MoveRecord.model_fields)
+        table = wandb.Table(
+            columns=columns,
+            data=[
+                [getattr(record, column) for column in columns]
+                for record in self.records
+            ],
+        )
+        wandb.log({"telemetry/moves": table})
+
+
+def _get_percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
@@ -0,0 +1,434 @@
+"""
+Tournaments between model checkpoints and RandomPlayer baselines, to pick the best
+checkpoint of a training run by playing strength instead of eval loss.
+
+Players are paired round-robin or Swiss, with balanced colors. The games are split
+into `n_shards` shards played in parallel, each one in its own Modal container
+(see `play_tournament_games`), on one event loop (see
+`fine_tune.game.play_games_async`), so every checkpoint batches the positions of
+all its games in the shard. Results are turned into Elo ratings, with bootstrap
+confidence intervals.
+"""
+
+import math
+import random
+from itertools import combinations
+from pathlib import Path
+
+import torch
+
+from .config import TrainingJobConfig
+from .game import ChessGameStats, schedule_games
+from .infra import (
+    get_docker_image_for_evaluation,
+    get_modal_app,
+    get_retries,
+    get_volume,
+)
+from .players import LLMPlayer, Player, RandomPlayer
+
+config = TrainingJobConfig()
+
+modal_app = get_modal_app()
+docker_image = get_docker_image_for_evaluation()
+model_checkpoints_volume = get_volume(config.modal_volume_model_checkpoints)
+
+
+@modal_app.function(
+    image=docker_image,
+    volumes={
+        "/model_checkpoints": model_checkpoints_volume,
+    },
+    timeout=config.modal_timeout_hours * 60 * 60,
+    retries=get_retries(),
+    max_inputs=1,  # Ensure we get a fresh container on retry
+)
+def run_tournament(
+    model_checkpoints: list[str],
+    n_random_players: int = 1,
+    pairing: str = "round-robin",
+    n_games_per_pair: int = 2,
+    n_rounds: int = 5,
+    decoding: str = "constrained",
+    max_concurrent_games: int = 256,
+    n_shards: int = 1,
+    seed: int = 0,
+) -> dict[str, dict]:
+    """
+    Plays a tournament between the `model_checkpoints` and `n_random_players`
+    RandomPlayer baselines, and returns the standings of each player.
+
+    This container only pairs the players: the games are split into `n_shards`
+    shards played by `play_tournament_games.starmap`, one GPU container per shard.
+    A Swiss tournament starts new shards at every round, since its pairings depend
+    on the results of the previous rounds.
+
+    Args:
+        model_checkpoints: Checkpoints in the model checkpoints volume, e.g.
+            "run/checkpoint-5000". A training run directory stands for all its
+            `checkpoint-*` directories.
+        pairing: "round-robin", where every pair plays `n_games_per_pair` games, or
+            "swiss", with `n_rounds` rounds of one game per player
+        decoding: Decoding mode of the LLMPlayers, see `LLMPlayer`
+        max_concurrent_games: Number of games played at the same time in a shard
+        seed: Seed of the first shard, the next shards get the following seeds
+    """
+    if pairing not in ("round-robin", "swiss"):
+        raise ValueError(f"Unknown pairing: {pairing}")
+
+    checkpoints = get_checkpoint_paths(Path("/model_checkpoints"), model_checkpoints)
+    names = checkpoints + [f"RandomPlayer-{i + 1}" for i in range(n_random_players)]
+    n_played_shards = 0
+
+    def play(pairings: list[tuple[str, str]]) -> list[ChessGameStats]:
+        nonlocal n_played_shards
+        shards = get_shards(pairings, n_shards)
+        shards_results = play_tournament_games.starmap(
+            (
+                shard,
+                checkpoints,
+                decoding,
+                max_concurrent_games,
+                seed + n_played_shards + i,
+            )
+            for i, shard in enumerate(shards)
+        )
+        n_played_shards += len(shards)
+        return [
+            ChessGameStats(**result)
+            for shard_results in shards_results
+            for result in shard_results
+        ]
+
+    if pairing == "round-robin":
+        pairings = get_round_robin_pairings(names, n_games_per_pair)
+        print(f"Round-robin: {len(pairings)} games")
+        results = play(pairings)
+    else:
+        results = []
+        for round_number in range(n_rounds):
+            pairings = get_swiss_pairings(names, results)
+            print(f"Swiss round {round_number + 1}/{n_rounds}: {len(pairings)} games")
+            results += play(pairings)
+
+    anchor = "RandomPlayer-1" if n_random_players > 0 else None
+    standings = get_standings(results, anchor=anchor)
+    print_standings(standings)
+    return standings
+
+
+@modal_app.function(
+    image=docker_image,
+    gpu=config.modal_gpu_type,
+    volumes={
+        "/model_checkpoints": model_checkpoints_volume,
+    },
+    timeout=config.modal_timeout_hours * 60 * 60,
+    retries=get_retries(),
+    max_inputs=1,  # Ensure we get a fresh container on retry
+)
+def play_tournament_games(
+    pairings: list[tuple[str, str]],
+    model_checkpoints: list[str],
+    decoding: str,
+    max_concurrent_games: int,
+    seed: int,
+) -> list[dict]:
+    """
+    Plays one shard of the tournament, the games of `pairings`, and returns their
+    stats as dicts. Only the `model_checkpoints` that play in the shard are loaded,
+    the other players are RandomPlayers.
+    """
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    players: dict[str, Player] = {}
+    for name in {name for pairing in pairings for name in pairing}:
+        if name in model_checkpoints:
+            player = LLMPlayer(
+                model_checkpoint_path=Path("/model_checkpoints") / name,
+                decoding=decoding,
+            )
+        else:
+            player = RandomPlayer()
+        # Game stats record players by name. It does not change when a player's
+        # games are aborted, see `Player.max_attempts`
+        player.name = name
+        players[name] = player
+
+    results = schedule_games(
+        [(players[white], players[black]) for white, black in pairings],
+        max_concurrent_games=max_concurrent_games,
+    )
+    return [result.model_dump() for result in results]
+
+
+@modal_app.local_entrypoint()
+def main(
+    model_checkpoints: str,
+    n_random_players: int = 1,
+    pairing: str = "round-robin",
+    n_games_per_pair: int = 2,
+    n_rounds: int = 5,
+    decoding: str = "constrained",
+    max_concurrent_games: int = 256,
+    n_shards: int = 1,
+):
+    """
+    `model_checkpoints` is a comma-separated list of checkpoints or training runs.
+    With `n_shards` > 1 the games are played in parallel, in `n_shards` containers.
+    """
+    print(f"Running a {pairing} tournament between {model_checkpoints}")
+
+    run_tournament.remote(
+        model_checkpoints=model_checkpoints.split(","),
+        n_random_players=n_random_players,
+        pairing=pairing,
+        n_games_per_pair=n_games_per_pair,
+        n_rounds=n_rounds,
+        decoding=decoding,
+        max_concurrent_games=max_concurrent_games,
+        n_shards=n_shards,
+    )
+
+    print("✅ Tournament completed!")
+
+
+def get_checkpoint_paths(root: Path, model_checkpoints: list[str]) -> list[str]:
+    """
+    Returns the checkpoints relative to `root`, replacing each training run
+    directory by its `checkpoint-*` directories, sorted by step.
+    """
+    checkpoint_paths = []
+    for model_checkpoint in model_checkpoints:
+        path = root / model_checkpoint
+        if path.name.startswith("checkpoint-"):
+            checkpoint_paths.append(model_checkpoint)
+            continue
+
+        checkpoints = sorted(
+            path.glob("checkpoint-*"), key=lambda p: int(p.name.split("-")[1])
+        )
+        if not checkpoints:
+            raise ValueError(f"No checkpoints found in {path}")
+        checkpoint_paths += [str(p.relative_to(root)) for p in checkpoints]
+
+    return checkpoint_paths
+
+
+def get_shards(
+    pairings: list[tuple[str, str]], n_shards: int
+) -> list[list[tuple[str, str]]]:
+    """
+    Splits `pairings` into at most `n_shards` contiguous shards of about the same
+    number of games. Round-robin pairings are grouped by player, so each shard
+    loads fewer checkpoints than if the games were dealt out in turns.
+    """
+    shard_size = max(-(-len(pairings) // n_shards), 1)
+    return [
+        pairings[start : start + shard_size]
+        for start in range(0, len(pairings), shard_size)
+    ]
+
+
+def get_round_robin_pairings(
+    names: list[str], n_games_per_pair: int
+) -> list[tuple[str, str]]:
+    """
+    Returns the (white, black) pairings of a round-robin where every pair of
+    players meets `n_games_per_pair` times, alternating colors.
+
+    The first game of each pair is oriented so that every player gets white in
+    about half of its first games, which keeps colors balanced when
+    `n_games_per_pair` is odd.
+    """
+    pairings = []
+    for (i, a), (j, b) in combinations(enumerate(names), 2):
+        first = (a, b) if (i + j) % 2 == 0 else (b, a)
+        for game_index in range(n_games_per_pair):
+            pairings.append(first if game_index % 2 == 0 else first[::-1])
+    return pairings
+
+
+def get_swiss_pairings(
+    names: list[str], results: list[ChessGameStats]
+) -> list[tuple[str, str]]:
+    """
+    Returns the (white, black) pairings of the next round of a Swiss tournament,
+    given the `results` of the previous rounds.
+
+    Players are sorted by score and each one meets the best ranked player it has
+    not played yet, if any. Of the two, the one that had white fewer times gets
+    white. With an odd number of players, the lowest ranked one sits out.
+    """
+    scores = get_scores(results)
+    n_whites = dict.fromkeys(names, 0)
+    opponents: dict[str, set[str]] = {name: set() for name in names}
+    for result in results:
+        n_whites[result.white_player] += 1
+        opponents[result.white_player].add(result.black_player)
+        opponents[result.black_player].add(result.white_player)
+
+    unpaired = sorted(names, key=lambda name: -scores.get(name, 0.0))
+    pairings = []
+    while len(unpaired) >= 2:
+        player = unpaired.pop(0)
+        opponent = next(
+            (name for name in unpaired if name not in opponents[player]), unpaired[0]
+        )
+        unpaired.remove(opponent)
+
+        if n_whites[player] <= n_whites[opponent]:
+            pairings.append((player, opponent))
+        else:
+            pairings.append((opponent, player))
+
+    return pairings
+
+
+def get_white_score(result: ChessGameStats) -> float:
+    """
+    Returns the points white got in the game: 1, 0.5 or 0.
+
+    An aborted game is lost by the player whose turn it was, the one that could
+    not come up with a valid move.
+    """
+    if result.result == "1-0":
+        return 1.0
+    if result.result == "0-1":
+        return 0.0
+    if result.result == "1/2-1/2":
+        return 0.5
+    white_to_move = len(result.moves) % 2 == 0
+    return 0.0 if white_to_move else 1.0
+
+
+def get_scores(results: list[ChessGameStats]) -> dict[str, float]:
+    scores: dict[str, float] = {}
+    for result in results:
+        white_score = get_white_score(result)
+        scores[result.white_player] = scores.get(result.white_player, 0.0) + white_score
+        scores[result.black_player] = (
+            scores.get(result.black_player, 0.0) + 1.0 - white_score
+        )
+    return scores
+
+
+def compute_elo_ratings(
+    games: list[tuple[str, str, float]],
+    anchor: str | None = None,
+    n_iterations: int = 1000,
+) -> dict[str, float]:
+    """
+    Returns the Elo rating of each player, fitted by maximum likelihood of the
+    Bradley-Terry model on `games`, a list of (white, black, white score).
+
+    Draws count as half a win for each player. Every player also gets one virtual
+    draw against a player of rating 0, so the ratings of players that won or lost
+    all their games stay finite.
+
+    Ratings are shifted so that `anchor` is rated 0, or so that the mean rating is 0
+    if there is no anchor.
+    """
+    names = sorted({name for white, black, _ in games for name in (white, black)})
+    wins = dict.fromkeys(names, 0.5)
+    n_games: dict[str, dict[str, int]] = {name: {} for name in names}
+    for white, black, white_score in games:
+        wins[white] += white_score
+        wins[black] += 1.0 - white_score
+        n_games[white][black] = n_games[white].get(black, 0) + 1
+        n_games[black][white] = n_games[black].get(white, 0) + 1
+
+    # Minorization-maximization updates of the strengths, 10^(elo / 400)
+    strengths = dict.fromkeys(names, 1.0)
+    for _ in range(n_iterations):
+        new_strengths = {}
+        for name in names:
+            denominator = 1.0 / (strengths[name] + 1.0)
+            for opponent, n in n_games[name].items():
+                denominator += n / (strengths[name] + strengths[opponent])
+            new_strengths[name] = wins[name] / denominator
+
+        converged = all(
+            abs(new_strengths[name] - strengths[name]) < 1e-9 * strengths[name]
+            for name in names
+        )
+        strengths = new_strengths
+        if converged:
+            break
+
+    ratings = {name: 400 * math.log10(strengths[name]) for name in names}
+    if anchor is not None and anchor in ratings:
+        offset = ratings[anchor]
+    else:
+        offset = sum(ratings.values()) / len(ratings)
+    return {name: rating - offset for name, rating in ratings.items()}
+
+
+def compute_elo_intervals(
+    games: list[tuple[str, str, float]],
+    anchor: str | None = None,
+    n_bootstrap: int = 200,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> dict[str, tuple[float, float]]:
+    """
+    Returns a `confidence` interval of the Elo rating of each player, from
+    `n_bootstrap` resamplings of the games with replacement.
+    """
+    rng = random.Random(seed)
+    samples: dict[str, list[float]] = {}
+    for _ in range(n_bootstrap):
+        resampled_games = rng.choices(games, k=len(games))
+        for name, rating in compute_elo_ratings(resampled_games, anchor).items():
+            samples.setdefault(name, []).append(rating)
+
+    intervals = {}
+    for name, ratings in samples.items():
+        ratings.sort()
+        low = ratings[int((1 - confidence) / 2 * (len(ratings) - 1))]
+        high = ratings[int((1 + confidence) / 2 * (len(ratings) - 1))]
+        intervals[name] = (low, high)
+    return intervals
+
+
+def get_standings(
+    results: list[ChessGameStats], anchor: str | None = None
+) -> dict[str, dict]:
+    """
+    Returns, for each player, its number of games, score, Elo rating and its
+    confidence interval, sorted by rating.
+    """
+    games = [
+        (result.white_player, result.black_player, get_white_score(result))
+        for result in results
+    ]
+    ratings = compute_elo_ratings(games, anchor)
+    intervals = compute_elo_intervals(games, anchor)
+    scores = get_scores(results)
+
+    n_games: dict[str, int] = {}
+    for white, black, _ in games:
+        n_games[white] = n_games.get(white, 0) + 1
+        n_games[black] = n_games.get(black, 0) + 1
+
+    return {
+        name: {
+            "n_games": n_games[name],
+            "score": scores[name],
+            "elo": ratings[name],
+            "elo_low": intervals[name][0],
+            "elo_high": intervals[name][1],
+        }
+        for name in sorted(ratings, key=lambda name: -ratings[name])
+    }
+
+
+def print_standings(standings: dict[str, dict]):
+    print(f"{'Player':<60} {'Games':>6} {'Score':>7} {'Elo':>7}   95% CI")
+    for name, standing in standings.items():
+        print(
+            f"{name:<60} {standing['n_games']:>6} {standing['score']:>7.1f} "
+            f"{standing['elo']:>7.0f}   "
+            f"[{standing['elo_low']:.0f}, {standing['elo_high']:.0f}]"
+        )
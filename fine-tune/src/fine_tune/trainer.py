@@ -17,6 +17,40 @@ def prepare_trainer(
     print("Extracting trainer parameters from TrainingJobConfig")
     training_args = get_training_arguments(config, checkpoint_path)
 
+    if not config.assistant_only_loss:
+        # The collator masks the prompt out of the loss whenever the (pre-tokenized)
+        # datasets have an `assistant_masks` column
+        train_dataset = _remove_assistant_masks(train_dataset)
+        eval_dataset = _remove_assistant_masks(eval_dataset)
+
+    data_collator, compute_loss_func = None, None
+    if config.completion_only_logits and not config.assistant_only_loss:
+        raise ValueError("completion_only_logits needs assistant_only_loss")
+    if config.padding_free:
+        from .collator import PaddingFreeCollator
+
+        if config.packing:
+            raise ValueError("packing and padding_free cannot be enabled together")
+        _check_padding_free_support(model)
+        data_collator = PaddingFreeCollator(
+            assistant_only_loss=config.assistant_only_loss,
+            completion_only_logits=config.completion_only_logits,
+        )
+    elif config.completion_only_logits:
+        from .collator import CompletionOnlyCollator
+
+        if config.packing:
+            raise ValueError(
+                "packing and completion_only_logits cannot be enabled together"
+            )
+        data_collator = CompletionOnlyCollator(pad_token_id=tokenizer.pad_token_id)
+    if config.completion_only_logits:
+        from .collator import compute_completion_loss
+
+        # The model gets no labels and returns the logits of the answer tokens
+        # only, the prompt logits are never materialized
+        compute_loss_func = compute_completion_loss
+
     # Initialize the supervised finetuning trainer
     print("Initializing SFTTrainer...")
     trainer = SFTTrainer(
@@ -28,6 +62,8 @@ def prepare_trainer(
         max_seq_length=config.max_seq_length,
         dataset_num_proc=config.preprocessing_workers,
         packing=config.packing,  # Sequence packing for efficiency
+        data_collator=data_collator,
+        compute_loss_func=compute_loss_func,
         args=training_args,
     )
 
@@ -67,7 +103,21 @@ def get_training_arguments(
         eval_steps=config.eval_steps,
         save_steps=config.save_steps,
         eval_strategy="no" if config.skip_eval else "steps",
-        save_strategy="steps",
+        # AsyncCheckpointCallback saves the checkpoints instead, off the training
+        # thread
+        save_strategy="no" if config.async_checkpointing else "steps",
+        # Retention policy: the last checkpoints and the best one
+        save_total_limit=(
+            None if config.async_checkpointing else config.checkpoints_keep_last
+        ),
+        metric_for_best_model=(
+            config.metric_for_best_checkpoint
+            if config.checkpoints_keep_last
+            and not config.async_checkpointing
+            and not config.skip_eval
+            else None
+        ),
+        greater_is_better=config.greater_is_better,
         do_eval=not config.skip_eval,
         # Optimization settings based on hardware capabilities
         fp16=not torch.cuda.is_bf16_supported(),  # Use fp16 if bf16 not available
@@ -80,4 +130,64 @@ def get_training_arguments(
         output_dir=str(output_path),
         report_to="wandb" if config.wandb_enabled else None,
         seed=config.seed,
+        # Batches of examples of similar length need less padding. The lengths are
+        # precomputed by `tokenize_conversations`
+        group_by_length=config.group_by_length,
+        length_column_name="length",
+        # Our collators read the `assistant_masks` column themselves
+        remove_unused_columns=not (
+            config.padding_free or config.completion_only_logits
+        ),
+        # Evaluation must pop the labels too, they do not match the model outputs
+        # with completion_only_logits
+        label_names=["labels"] if config.completion_only_logits else None,
+    )
+
+
+def _remove_assistant_masks(dataset: "Dataset") -> "Dataset":
+    if "assistant_masks" in dataset.column_names:
+        return dataset.remove_columns("assistant_masks")
+    return dataset
+
+
+def _check_padding_free_support(model: "Model"):
+    """
+    Raises an error if the attention of `model` would not respect the boundaries of
+    the examples the padding-free collator concatenates, or if the model has layers
+    other than attention that mix tokens.
+    """
+    if _has_conv_layers(model):
+        # The short convolutions of hybrid models like LFM2 slide over the whole
+        # row: the first tokens of an example see the last tokens of the previous
+        # one, whatever the `position_ids`, and that state reaches every later
+        # token of the example through the next layers. This version of
+        # transformers cannot reset the convolution state at example boundaries.
+        raise ValueError(
+            f"padding_free would mix the examples of a batch in the convolution "
+            f"layers of {model.config.model_type}, use padded batches instead "
+            f"(completion_only_logits works with them too)"
+        )
+
+    attn_implementation = model.config._attn_implementation
+    if "flash_attention" in attn_implementation:
+        return
+
+    try:
+        # Versions of transformers that build block-diagonal masks for sdpa and eager
+        # attention from the `position_ids` of packed sequences
+        from transformers.masking_utils import find_packed_sequence_indices  # noqa: F401
+    except ImportError:
+        raise ValueError(
+            f"padding_free needs flash attention with this version of transformers, "
+            f"but the model uses {attn_implementation} attention"
+        ) from None
+
+
+def _has_conv_layers(model: "Model") -> bool:
+    """
+    Returns True if `model` has convolution layers, like the LFM2 models.
+    """
+    layer_types = getattr(model.config, "layer_types", None) or []
+    return getattr(model.config, "conv_L_cache", None) is not None or any(
+        "conv" in layer_type for layer_type in layer_types
     )